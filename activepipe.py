@@ -1,17 +1,75 @@
+import copy
+import functools
 import pickle
 import numpy as np
+import time
 
+from buffers import LazyHeap
 from corpus import Corpus
+from evaluation import CorpusEvaluation
+from multiprocessing.pool import ThreadPool
+from parallel_em import EMProcessPool, EMSums, add_unlabeled_chunk
+from query_strategies import STRATEGIES as QUERY_STRATEGIES
 from random import randint
-from scipy.sparse import vstack
-from sklearn.metrics import (precision_score, classification_report,
-                             confusion_matrix)
+from scipy.sparse import csr_matrix, vstack
+from sklearn.base import clone
+from sklearn.metrics import precision_score
 from sklearn.utils.extmath import safe_sparse_dot
 from sklearn.preprocessing import normalize
 
 from defaults import default_config
 
 
+def _load_corpus(filename):
+    corpus = Corpus()
+    corpus.load_from_file(filename)
+    return corpus
+
+
+class _LazyCorpus(object):
+    """A corpus attribute of the pipe that is loaded when it is first read.
+
+    While the attribute is None, reading it loads the corpus from the file
+    given by the configuration filename_key. The attribute can also be
+    assigned to a Corpus or to an object with a get method, like a
+    multiprocessing AsyncResult, that returns the Corpus. The get method is
+    called the first time the attribute is read.
+    """
+    def __init__(self, name, filename_key):
+        self.name = '_' + name
+        self.filename_key = filename_key
+
+    def __get__(self, pipe, owner):
+        if pipe is None:
+            return self
+        value = pipe.__dict__.get(self.name)
+        if value is None:
+            value = _load_corpus(getattr(pipe, self.filename_key))
+            pipe.__dict__[self.name] = value
+        elif not isinstance(value, Corpus) and hasattr(value, 'get'):
+            value = value.get()
+            pipe.__dict__[self.name] = value
+        return value
+
+    def is_loaded(self, pipe):
+        """Returns True if the corpus of pipe was read or assigned."""
+        return pipe.__dict__.get(self.name) is not None
+
+    def __set__(self, pipe, value):
+        pipe.__dict__[self.name] = value
+
+
+def _requires_training(method):
+    """Trains the pipe before calling method if the training was deferred.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not self._initialized:
+            self._initial_training()
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
 class ActivePipeline(object):
     """
     Attributes:
@@ -27,6 +85,11 @@ class ActivePipeline(object):
 
         test_corpus:
 
+        The three corpus are loaded from their files the first time they are
+        read. The training and unlabeled corpus are loaded concurrently in
+        background threads before the first training, and the test corpus
+        only when the classifier is evaluated.
+
         feature_corpus: A matrix of shape [n_class, n_feat] with three possible
         values. -1 indicates that the feature was never asked to the user for
         that class, 0 indicates no relation, and 1 indicates relation between
@@ -35,7 +98,10 @@ class ActivePipeline(object):
         during user emulation. It can be updated using the function
         label_feature_corpus.
 
-        recorded_precision:
+        recorded_precision: A list with a dictionary for each training, with
+        the precision of the classifier over the test and training corpus.
+        If the training was deferred, the first classifier is evaluated
+        when the list is first read.
 
         new_instances:
 
@@ -57,7 +123,10 @@ class ActivePipeline(object):
             **kwargs: the configuration for the pipe. Each parameters passed
             will be converted to an attribute of the pipe. The minimum
             configuration possible is set in the defaults file, and each value
-            not passed as a parameter will be taken from there.
+            not passed as a parameter will be taken from there. If
+            defer_training is True, the classifier is trained the first time
+            it is needed instead of in the constructor, and evaluated the
+            first time recorded_precision is read.
         """
         self.session_filename = session_filename
         self.emulate = emulate
@@ -73,150 +142,439 @@ class ActivePipeline(object):
         self.new_instances = 0
         self.new_features = 0
         self.classes = []
-        self._train()
+        self._fitted_state = None
+        self._fitted_user_rows = 0
+        self._fitted_version = None
+        self._labeled_rows_cache = (None, None)
+        self._evaluations = {}
+        self._suggestions_key = None
+        self._suggestions = {}
+        self._instance_heap = None
+        self._posterior_cache = None
+        self._scores_key = None
+        self._scored_next_row_id = None
+        self._candidate_cache = {}
+        self._initialized = False
+        if not self.defer_training:
+            self._initial_training()
+
+    def _initial_training(self):
+        """Trains the classifier and builds the matrices of user features."""
+        self._initialized = True
+        self._load_corpora(['training_corpus', 'unlabeled_corpus'])
+        self._train(defer_evaluation=self.defer_training)
         self._build_feature_boost()
 
     def _set_config(self, config):
         """Sets the keys of config+default_config dict as an attribute of self.
+
+        The default classifier is copied, because the pipe modifies it.
         """
-        default_config.update(config)
-        for key, value in default_config.items():
+        config = dict(default_config, **config)
+        if config['classifier'] is default_config['classifier']:
+            config['classifier'] = clone(config['classifier'])
+        if 'dtype' in config['classifier'].get_params():
+            config['classifier'].set_params(dtype=config['dtype'])
+        for key, value in config.items():
             if value is not None:
                 setattr(self, key, value)
 
+    training_corpus = _LazyCorpus('training_corpus', 'training_corpus_f')
+    unlabeled_corpus = _LazyCorpus('unlabeled_corpus', 'u_corpus_f')
+    test_corpus = _LazyCorpus('test_corpus', 'test_corpus_f')
+
     def _get_corpus(self):
-        self.training_corpus = Corpus()
-        self.training_corpus.load_from_file(self.training_corpus_f)
+        """Sets the training, unlabeled and test corpus to be loaded from
+        their files when they are first read."""
+        self.training_corpus = None
+        self.unlabeled_corpus = None
+        self.test_corpus = None
 
-        self.unlabeled_corpus = Corpus()
-        self.unlabeled_corpus.load_from_file(self.u_corpus_f)
+        self.user_corpus = Corpus()
 
-        self.test_corpus = Corpus()
-        self.test_corpus.load_from_file(self.test_corpus_f)
+    def _load_corpora(self, names):
+        """Starts loading concurrently the corpora in names not loaded yet.
 
-        self.user_corpus = Corpus()
+        Args:
+            names: a list with names of _LazyCorpus attributes of the pipe.
+        """
+        names = [name for name in names
+                 if not getattr(type(self), name).is_loaded(self)]
+        if len(names) < 2:
+            return
+        pool = ThreadPool(len(names))
+        for name in names:
+            filename = getattr(self, getattr(type(self), name).filename_key)
+            setattr(self, name, pool.apply_async(_load_corpus, (filename,)))
+        pool.close()
+
+    def _get_recorded_precision(self):
+        for record, classifier in self._pending_evaluations:
+            record.update(self._evaluate_classifier(classifier))
+        self._pending_evaluations = []
+        return self._recorded_precision
+
+    def _set_recorded_precision(self, value):
+        self._recorded_precision = value
+        self._pending_evaluations = []
+
+    recorded_precision = property(_get_recorded_precision,
+                                  _set_recorded_precision)
 
     def _get_feature_corpus(self):
         """Loads the feature corpus from self.feature_corpus_f"""
         if self.feature_corpus_f:
             f = open(self.feature_corpus_f, 'r')
-            self.feature_corpus = pickle.load(f)
+            self.feature_corpus = np.asarray(pickle.load(f), dtype=np.int8)
             f.close()
         else:
             self.feature_corpus = None
 
     def _build_feature_boost(self):
-        """Creates the user_features np.array with defaults values."""
+        """Creates the user_features np.array with defaults values.
+
+        user_features has the type given by the dtype configuration, and
+        asked_features is a boolean mask.
+        """
         if self._build_feature_boost_function is not None:
             self._build_feature_boost_function(self)
         else:
             self.alpha = self.classifier.alpha
             self.n_class, self.n_feat = self.classifier.feature_log_prob_.shape
-            self.user_features = np.array([[self.alpha] * self.n_feat] * self.n_class)
+            self.user_features = np.full((self.n_class, self.n_feat),
+                                         self.alpha, dtype=self.dtype)
             if self.emulate:
                 self.asked_features = self.feature_corpus == 0
             else:
-                self.asked_features = self.user_features != self.alpha # False
+                self.asked_features = np.zeros((self.n_class, self.n_feat),
+                                               dtype=bool)
 
-    def _train(self):
+    def _train(self, defer_evaluation=False):
         """Fit the classifier with the training set plus the new vectors and
         features. Then performs a step of EM.
+
+        Args:
+            defer_evaluation: Optional. If True, a copy of the classifier is
+            evaluated when recorded_precision is read, so the training does
+            not wait for the test corpus.
         """
-        try:
-            if len(self.user_corpus):
-                self.classifier.fit(
-                    vstack((self.training_corpus.instances,
-                            self.user_corpus.instances), format='csr'),
-                    (self.training_corpus.primary_targets +
-                     self.user_corpus.primary_targets),
-                    features=self.user_features
-                )
-            else:
-                self.classifier.fit(self.training_corpus.instances,
-                                    self.training_corpus.primary_targets,
-                                    features=self.user_features)
-        except ValueError:
-            import ipdb; ipdb.set_trace()
-        self.recorded_precision.append({
-            'testing_precision' : self.evaluate_test(),
-            'training_precision' : self.evaluate_training(),
+        # The pool will be classified again, so it is a good moment to
+        # remove the instances labeled since the last training.
+        self.unlabeled_corpus.compact()
+        self._fit_classifier()
+        record = {
             'new_instances' : self.new_instances,
             'new_features' : self.new_features,
-            'confusion_matrix': confusion_matrix(
-                self.test_corpus.primary_targets,
-                self.predict(self.test_corpus.instances)
+        }
+        if defer_evaluation:
+            self._pending_evaluations.append(
+                (record, copy.deepcopy(self.classifier))
             )
-        })
+        else:
+            record.update(self._evaluate_classifier(self.classifier))
+        self._recorded_precision.append(record)
         self.new_instances = 0
         self.new_features = 0
         self.classes = self.classifier.classes_.tolist()
-        self._retrained = True
 
+    def _fit_classifier(self):
+        """Fits the classifier with the training corpus plus the user corpus.
+
+        If the classifier was already fitted by the pipe with the same
+        training corpus, and the instances added to the user corpus since
+        then have known classes, only the new instances are added to the
+        counts of the classifier with partial_fit. If there are no new
+        instances and the classifier only changed with
+        update_class_features, it is not modified.
+        """
+        n_user = len(self.user_corpus)
+        state = (self.classifier, self.training_corpus,
+                 self.training_corpus.version, self.deduplicate)
+        if (self.incremental_training and self._fitted_state == state and
+                self._fitted_user_rows <= n_user):
+            start = self._fitted_user_rows
+            targets = self.user_corpus.primary_targets[start:]
+            if (not targets and self._fitted_version is not None and
+                    self._counts_key() == (self.classifier,
+                                           self._fitted_version) and
+                    np.array_equal(self.classifier.alpha,
+                                   self.user_features)):
+                # The classifier only changed with update_class_features
+                # since it was fitted, so it is up to date, and its cached
+                # values are kept.
+                return
+            if set(targets) <= set(self.classifier.classes_.tolist()):
+                if targets:
+                    instances = self.user_corpus.instances[start:]
+                else:
+                    # Only the features of the user changed
+                    instances = self.training_corpus.instances[:0]
+                self.classifier.partial_fit(instances, targets,
+                                            features=self.user_features)
+                self._fitted_user_rows = n_user
+                self._fitted_version = getattr(self.classifier,
+                                               'model_version', None)
+                return
+        training_corpus, weights, _ = self._weighted_rows(
+            self.training_corpus, by_target=True
+        )
+        if weights is not None and n_user:
+            weights = np.concatenate((weights, np.ones(n_user)))
+        if n_user:
+            self.classifier.fit(
+                vstack((training_corpus.instances,
+                        self.user_corpus.instances), format='csr'),
+                (training_corpus.primary_targets +
+                 self.user_corpus.primary_targets),
+                sample_weight=weights, features=self.user_features
+            )
+        else:
+            self.classifier.fit(training_corpus.instances,
+                                training_corpus.primary_targets,
+                                sample_weight=weights,
+                                features=self.user_features)
+        self._fitted_state = state
+        self._fitted_user_rows = n_user
+        self._fitted_version = getattr(self.classifier, 'model_version', None)
+
+    @_requires_training
     def _expectation_maximization(self):
+        """Runs expectation maximization until the likelihood converges.
+
+        Each iteration re estimates the parameters of the multinomial
+        (class_prior and feature_log_prob_) to maximize the expected
+        likelihood, starting from the current parameters of the classifier.
+        The likelihood is calculated with a probabilistic labeling of the
+        unlabeled corpus plus the known labels from the labeled corpus, and
+        the features are smoothed with the alpha of the classifier, that
+        includes the boost of the user features, like in its fit method.
+        Each iteration never decreases the likelihood.
+
+        The iterations stop when the relative change of the log likelihood
+        is less than em_tolerance, or after em_max_iterations. If
+        em_processes is more than 1, the statistics of the unlabeled corpus
+        are calculated by that number of processes.
+
+        Returns:
+            A list with a dictionary for each iteration, with the keys
+            'log_likelihood' (of the parameters the iteration started with,
+            see _em_iteration) and 'seconds'. It is also stored in
+            self.em_report.
+        """
+        self.em_report = []
+        pool = None
+        if self.em_processes > 1 and len(self.unlabeled_corpus):
+            unlabeled_corpus, weights, _ = self._weighted_rows(
+                self.unlabeled_corpus
+            )
+            pool = EMProcessPool(unlabeled_corpus.instances,
+                                 len(self.classifier.classes_),
+                                 self.em_processes, weights, self.dtype,
+                                 self.chunk_size)
+        try:
+            previous = None
+            for iteration in range(self.em_max_iterations):
+                start_time = time.time()
+                log_likelihood = self._em_iteration(pool)
+                self.em_report.append({'log_likelihood': log_likelihood,
+                                       'seconds': time.time() - start_time})
+                if (previous is not None and
+                        abs(log_likelihood - previous) <=
+                        self.em_tolerance * abs(previous)):
+                    break
+                previous = log_likelihood
+        finally:
+            if pool is not None:
+                pool.close()
+        return self.em_report
+
+    def _em_iteration(self, pool=None):
         """Performs one cycle of expectation maximization.
 
-        Re estimates the parameters of the multinomial (class_prior and
-        feature_log_prob_) to maximize the expected likelihood. The likelihood
-        is calculated with a probabilistic labeling of the unlabeled corpus
-        plus the known labels from the labeled corpus.
+        The E-step gives each unlabeled instance the probability of each
+        class given the instance, and the labeled instances their class.
+        The M-step estimates the parameters from the expected counts of the
+        unlabeled instances, weighted by em_unlabeled_weight, plus the
+        counts of the labeled ones, weighted by 1 - em_unlabeled_weight.
+        The feature counts are smoothed with the alpha of the classifier.
+        The class prior is only estimated if the classifier fits it.
+
+        Args:
+            pool: Optional. An EMProcessPool with the unlabeled instances.
+
+        Returns:
+            The value maximized by EM with the parameters of the classifier
+            before the cycle: the weighted log likelihood of the corpora
+            plus the sum of alpha times the log probability of each feature,
+            the log prior of the parameters given by the smoothing.
         """
-        # E-step: Classify the unlabeled pool
-        predicted_proba = self.classifier.predict_proba(
-            self.unlabeled_corpus.instances
-        )
-        # M-step: Maximizing the likelihood
-        # Unlabeled component
-        instance_proba = self.classifier.instance_proba(
-            self.unlabeled_corpus.instances
-        )
-        predicted_proba = predicted_proba.T * instance_proba
-        class_prior = predicted_proba.sum(axis=1)
-        feature_prob = safe_sparse_dot(predicted_proba,
-                                      self.unlabeled_corpus.instances)
+        classifier = self.classifier
+        n_class, n_feat = classifier.feature_log_prob_.shape
+        # The counts of the M-step are accumulated over chunks of the
+        # corpus, so the probabilities of the whole pool are never in
+        # memory.
+        sums = EMSums(n_class, n_feat, self.dtype)
+        if pool is not None:
+            log_likelihood = pool.add_statistics(
+                sums, classifier.log_prob_columns(),
+                classifier.class_log_prior_
+            )
+        else:
+            log_likelihood = 0.0
+            unlabeled_corpus, weights, _ = self._weighted_rows(
+                self.unlabeled_corpus
+            )
+            for start, instances in unlabeled_corpus.iter_chunks(
+                    self.chunk_size):
+                # E-step: Classify the unlabeled pool
+                jll, _ = classifier.joint_and_instance_log_proba(instances)
+                log_likelihood += add_unlabeled_chunk(
+                    sums, jll, instances,
+                    None if weights is None else
+                    weights[start:start + instances.shape[0]]
+                )
+        class_count, feature_count = sums.class_count, sums.feature_count
 
         if len(self.training_corpus) != 0:
             # Labeled component
-            instance_proba = self.classifier.instance_proba(
-                self.training_corpus.instances
+            labeled_class_count, labeled_feature_count = \
+                self._labeled_rows()[4:]
+            # The log likelihood of the labeled instances only depends on
+            # their counts
+            unlabeled_weight = self.em_unlabeled_weight
+            log_likelihood = (
+                unlabeled_weight * log_likelihood +
+                (1 - unlabeled_weight) * (
+                    np.dot(labeled_class_count, classifier.class_log_prior_) +
+                    (labeled_feature_count *
+                     classifier.feature_log_prob_).sum()
+                )
             )
-            instance_class_matrix = self._get_instance_class_matrix()
-            predicted_proba = instance_class_matrix.T * instance_proba
-            l_class_prior = predicted_proba.sum(axis=1)
-            l_feat_prob = safe_sparse_dot(predicted_proba,
-                                          self.training_corpus.instances)
-            class_prior = 0.1 * class_prior + 0.9 * l_class_prior
-            feature_prob = 0.1 * feature_prob + 0.9 * l_feat_prob
-
-        self.classifier.class_log_prior_ = np.log(class_prior /
-                                                  class_prior.sum())
-        self.classifier.feature_log_prob_ = np.log(normalize(feature_prob,
-                                                             norm='l1'))
-
-    def _get_instance_class_matrix(self):
+            class_count = (unlabeled_weight * class_count +
+                           (1 - unlabeled_weight) * labeled_class_count)
+            feature_count = (unlabeled_weight * feature_count +
+                             (1 - unlabeled_weight) * labeled_feature_count)
+
+        # M-step: Maximizing the likelihood
+        log_likelihood += (classifier.alpha *
+                           classifier.feature_log_prob_).sum()
+        if classifier.fit_prior and classifier.class_prior is None:
+            classifier.class_log_prior_ = (np.log(class_count) -
+                                           np.log(class_count.sum()))
+        smoothed = feature_count + classifier.alpha
+        classifier.feature_log_prob_ = (
+            np.log(smoothed) - np.log(smoothed.sum(axis=1))[:, np.newaxis]
+        )
+        return log_likelihood
+
+    def _get_instance_class_matrix(self, corpus=None):
         """Returns a binary matrix for the training instances and its labels.
 
+        Args:
+            corpus: Optional. The labeled Corpus, by default the training
+            corpus.
+
         Returns:
-            An array like, shape = [n_instances, n_class]. Each element is
+            A csr_matrix, shape = [n_instances, n_class]. Each element is
             one if the instances is labeled with the class in the training
             corpus.
         """
-        m1 = np.arange(len(self.classes))
-        m1 = m1.reshape((1, len(self.classes)))
-        m1 = np.repeat(m1, len(self.training_corpus), axis=0)
-        m2 = np.zeros((len(self.training_corpus), len(self.classes)))
-        for i in range(len(self.training_corpus)):
-            class_index = self.classes.index(
-                self.training_corpus.primary_targets[i]
+        if corpus is None:
+            corpus = self.training_corpus
+        class_positions = self._class_positions(corpus)
+        class_positions = class_positions[corpus.primary_target_codes]
+        assert np.all(class_positions >= 0)
+        return csr_matrix(
+            (np.ones(len(corpus), dtype=np.int8), class_positions,
+             np.arange(len(corpus) + 1)),
+            shape=(len(corpus), len(self.classes))
+        )
+
+    def _labeled_rows(self):
+        """Returns the rows of the training corpus for the labeled component
+        of EM, and their counts.
+
+        The result only depends on the training corpus and the classes, so
+        it is cached until one of them changes.
+
+        Returns:
+            A tuple (corpus, weights, positions, instance_class_matrix,
+            class_count, feature_count), with the corpus and weights
+            returned by _weighted_rows, the position in self.classes of the
+            class of each row, the result of _get_instance_class_matrix for
+            the corpus, the number of instances of each class and the sum of
+            the instances of each class.
+        """
+        key = (self.training_corpus, self.training_corpus.version,
+               tuple(self.classes), self.deduplicate)
+        cached_key, result = self._labeled_rows_cache
+        if cached_key != key:
+            training_corpus, weights, _ = self._weighted_rows(
+                self.training_corpus, by_target=True
+            )
+            instance_class_matrix = self._get_instance_class_matrix(
+                training_corpus
+            )
+            class_count = np.zeros(len(self.classes))
+            feature_count = np.zeros(
+                (len(self.classes), self.classifier.feature_log_prob_.shape[1])
             )
-            m2[i] = class_index
-        result = (m1 == m2).astype(np.int8, copy=False)
-        assert np.all(result.sum(axis=1) == 1)
-        assert result.sum() == len(self.training_corpus)
+            for start, instances in training_corpus.iter_chunks(
+                    self.chunk_size):
+                end = start + instances.shape[0]
+                indicator = instance_class_matrix[start:end].T.astype(
+                    np.float64
+                )
+                if weights is not None:
+                    indicator = indicator.multiply(weights[start:end]).tocsr()
+                class_count += np.asarray(indicator.sum(axis=1)).ravel()
+                feature_count += safe_sparse_dot(indicator, instances,
+                                                 dense_output=True)
+            result = (training_corpus, weights, instance_class_matrix.indices,
+                      instance_class_matrix, class_count, feature_count)
+            self._labeled_rows_cache = (key, result)
         return result
 
+    def _weighted_rows(self, corpus, by_target=False):
+        """Returns the rows of corpus to process and the weight of each one.
+
+        If the pipe was configured with deduplicate, the identical instances
+        of corpus are processed only once, weighted by their number of
+        copies.
+
+        Args:
+            corpus: a Corpus.
+            by_target: Optional. If True, the identical instances are only
+            collapsed when they have the same primary target.
+
+        Returns:
+            A tuple (corpus, weights, inverse). weights is a numpy array with
+            the number of instances of the original corpus in each row, and
+            inverse the row of the result of each original instance (see
+            Corpus.deduplicate). Both are None if the corpus is not
+            deduplicated.
+        """
+        if not self.deduplicate:
+            return corpus, None, None
+        unique_corpus, inverse = corpus.deduplicate(by_target)
+        return unique_corpus, unique_corpus.extra_info['weight'], inverse
+
+    def _class_positions(self, corpus):
+        """Maps the class codes of corpus to positions in self.classes.
+
+        Returns:
+            A numpy array with the position in self.classes of each class in
+            corpus.classes, or -1 if the class is unknown to the classifier.
+            The last element is -1, the position for the code -1.
+        """
+        positions = dict((c, i) for i, c in enumerate(self.classes))
+        return np.array([positions.get(c, -1) for c in corpus.classes] + [-1],
+                        dtype=np.int64)
+
     def predict(self, question):
         return self.classifier.predict(question)
 
+    @_requires_training
     def handle_feature_prediction(self, class_number, full_set, prediction):
         """Adds the new information from prediction to user_features.
 
@@ -227,6 +585,9 @@ class ActivePipeline(object):
             prediction: a list of positions of features selected for the class.
             The features not present in this class are considered as negative
             examples.
+
+        The feature probabilities of the class are updated in the classifier
+        without training it again.
         """
         for feature in full_set:
             if feature in prediction:
@@ -234,7 +595,32 @@ class ActivePipeline(object):
                      self.feature_boost
             self.asked_features[class_number][feature] = True
         self.new_features += len(prediction)
+        if hasattr(self.classifier, 'update_class_features'):
+            # Only the probabilities of this class change
+            self.classifier.update_class_features(
+                class_number, self.user_features[class_number]
+            )
+
+    def _top_classes(self, log_proba, k):
+        """Returns the k classes with the highest log_proba for each row.
 
+        Only the k best classes of each row are sorted.
+
+        Args:
+            log_proba: an array, shape = [n_instances, n_class].
+            k: a positive integer less or equal than n_class.
+
+        Returns:
+            A list with a list of classes for each row, sorted from the most
+            probable, followed by the last class of self.classes.
+        """
+        top = np.argpartition(-log_proba, k - 1, axis=1)[:, :k]
+        rows = np.arange(log_proba.shape[0])[:, np.newaxis]
+        top = top[rows, np.argsort(-log_proba[rows, top], axis=1)]
+        return [classes + [self.classes[-1]]
+                for classes in self.classifier.classes_[top].tolist()]
+
+    @_requires_training
     def _most_probable_classes(self, instance):
         """Return a list of the most probable classes for the given instance.
 
@@ -245,41 +631,299 @@ class ActivePipeline(object):
             A list of classes of len given by the number_of_classes in the
             initial configuration.
         """
-        classes = self.classifier.predict_log_proba(instance)
-        indexes = classes.argsort()
-        result = []
-        indexes = indexes[0].tolist()
-        indexes.reverse()
-        for index in indexes[:self.number_of_classes]:
-            result.append(self.classes[index])
-        result.append(self.classes[-1])
-        return result
+        k = min(self.number_of_classes, len(self.classes))
+        return self._top_classes(self.classifier.predict_log_proba(instance),
+                                 k)[0]
+
+    @_requires_training
+    def most_probable_classes(self, rows, k=None):
+        """Returns the most probable classes for several unlabeled instances.
 
+        All the instances that were not asked before are classified at once,
+        and the result for each row is cached until the classifier changes,
+        so the suggestions for the next questions can be calculated in
+        advance.
+
+        Args:
+            rows: a list of row ids of the unlabeled corpus.
+            k: Optional. The number of classes for each instance. By default
+            number_of_classes.
+
+        Returns:
+            A list with a list of classes for each row, sorted from the most
+            probable, followed by the last class of self.classes.
+        """
+        k = min(k or self.number_of_classes, len(self.classes))
+        key = (self.classifier,
+               getattr(self.classifier, 'model_version', None), k)
+        if key[1] is None or key != self._suggestions_key:
+            self._suggestions = {}
+            self._suggestions_key = key
+        missing = [row for row in rows if row not in self._suggestions]
+        if missing:
+            log_proba = self.classifier.predict_log_proba(
+                self.unlabeled_corpus.get_instances(missing)
+            )
+            self._suggestions.update(zip(missing,
+                                         self._top_classes(log_proba, k)))
+        return [self._suggestions[row] for row in rows]
+
+    @_requires_training
     def get_next_instance(self):
         """Selects the index of an unlabeled instance to be sent to the user.
 
         Returns:
-            The index of an instance selected from the unlabeled_corpus.
+            The row id of an instance selected from the unlabeled_corpus. It
+            can be used with the methods get_instance and pop_instance of
+            the corpus.
         """
         if self.get_next_instance_function is not None:
-            self.get_next_instance_function(self)
+            return self.get_next_instance_function(self)
+        if len(self.unlabeled_corpus) == 0:
+            return None
+        name = self._score_unlabeled()
+        # Select the instance. The popped instances are skipped, and the
+        # heap is built again only when all its instances were popped.
+        row_id = None
+        if self._instance_heap is not None:
+            row_id = self._instance_heap.peek(
+                self.unlabeled_corpus.__contains__
+            )
+        if row_id is None:
+            self._instance_heap = LazyHeap(
+                self.unlabeled_corpus.extra_info[name],
+                self.unlabeled_corpus.row_ids
+            )
+            row_id = self._instance_heap.peek(
+                self.unlabeled_corpus.__contains__
+            )
+        return row_id
+
+    def _unlabeled_posterior(self):
+        """Returns the probability of each class for each unlabeled instance.
+
+        The probabilities are calculated chunk by chunk and cached. If the
+        classifier only changed by update_class_features since then, the
+        cached probabilities are updated instead (see _patch_posterior),
+        and if instances were popped from the unlabeled corpus, the rows of
+        the remaining ones are kept.
+
+        Returns:
+            A tuple (corpus, posterior, inverse), where corpus and inverse
+            are the ones returned by _weighted_rows for the unlabeled corpus,
+            and posterior an array of shape [len(corpus), n_class].
+        """
+        cache = self._posterior_cache
+        model_version = getattr(self.classifier, 'model_version', None)
+        if (cache is None or model_version is None or
+                cache['corpus'] is not self.unlabeled_corpus or
+                cache['classifier'] is not self.classifier or
+                cache['deduplicate'] != self.deduplicate or
+                not self._select_posterior_rows(cache) or
+                not self._patch_posterior(cache, model_version)):
+            cache = self._calculate_posterior()
+        return cache['rows'], cache['posterior'], cache['inverse']
+
+    def _calculate_posterior(self):
+        """Classifies the unlabeled corpus and caches the probabilities.
+
+        Returns:
+            The dictionary stored in self._posterior_cache.
+        """
+        unlabeled_corpus, _, inverse = self._weighted_rows(
+            self.unlabeled_corpus
+        )
+        posterior = np.empty((len(unlabeled_corpus),
+                              len(self.classifier.classes_)),
+                             dtype=self.dtype)
+        for start, instances in unlabeled_corpus.iter_chunks(
+                self.chunk_size):
+            posterior[start:start + instances.shape[0]] = \
+                self.classifier.predict_proba(instances)
+        if self.deduplicate:
+            row_ids = np.arange(len(unlabeled_corpus))
         else:
-            if len(self.unlabeled_corpus) == 0:
-                return None
-            if self._retrained:
-                self.u_clasifications = self.classifier.predict_proba(
-                    self.unlabeled_corpus.instances
+            row_ids = unlabeled_corpus.row_ids.copy()
+        matrix = unlabeled_corpus.instances
+        self._posterior_cache = {
+            'corpus': self.unlabeled_corpus,
+            'version': self.unlabeled_corpus.version,
+            'classifier': self.classifier,
+            'model_version': getattr(self.classifier, 'model_version', None),
+            'deduplicate': self.deduplicate,
+            'rows': unlabeled_corpus,
+            'inverse': inverse,
+            'posterior': posterior,
+            'row_ids': row_ids,
+            'lengths': (np.asarray(matrix.sum(axis=1)).ravel() if len(row_ids)
+                        else np.zeros(0)),
+            # The column index is built when it is first needed
+            'matrix': matrix,
+            'index': None,
+            'index_row_ids': row_ids,
+        }
+        return self._posterior_cache
+
+    def _select_posterior_rows(self, cache):
+        """Keeps the cached probabilities of the instances that were not
+        popped from the unlabeled corpus.
+
+        Returns:
+            False if the cache can not be used because the corpus has new
+            instances, or it is deduplicated and has changed.
+        """
+        corpus = self.unlabeled_corpus
+        if cache['version'] == corpus.version:
+            return True
+        if self.deduplicate:
+            return False
+        row_ids = corpus.row_ids
+        positions = cache['row_ids'].searchsorted(row_ids)
+        if (len(row_ids) and (positions[-1] >= len(cache['row_ids']) or
+                np.any(cache['row_ids'][positions] != row_ids))):
+            return False
+        cache['posterior'] = cache['posterior'][positions]
+        cache['lengths'] = cache['lengths'][positions]
+        cache['row_ids'] = row_ids.copy()
+        cache['rows'] = corpus
+        cache['version'] = corpus.version
+        return True
+
+    def _patch_posterior(self, cache, model_version):
+        """Applies to the cached probabilities the changes of the classifier
+        made by update_class_features, see FeatMultinomialNB.feature_updates.
+
+        The change of the normalization of the class shifts the joint log
+        likelihood of every instance, in proportion to its length, and only
+        the instances that have some of the changed features, found with a
+        csc index of the columns, are multiplied by the changed columns.
+
+        Returns:
+            False if some change of the classifier since the probabilities
+            were calculated was not made by update_class_features.
+        """
+        updates = getattr(self.classifier, 'feature_updates', {})
+        posterior = cache['posterior']
+        n_class = posterior.shape[1]
+        while cache['model_version'] != model_version:
+            update = updates.get(cache['model_version'])
+            if update is None:
+                return False
+            class_number, columns, column_change, shift = update
+            change = shift * cache['lengths']
+            if len(columns) and len(change):
+                if cache['index'] is None:
+                    cache['index'] = cache['matrix'].tocsc()
+                block = cache['index'][:, columns].tocoo()
+                affected, position = np.unique(block.row, return_inverse=True)
+                row_change = np.bincount(
+                    position, minlength=len(affected),
+                    weights=block.data * (column_change - shift)[block.col]
+                )
+                # The rows of the index that are still in the corpus
+                row_ids = cache['index_row_ids'][affected]
+                positions = np.minimum(
+                    cache['row_ids'].searchsorted(row_ids),
+                    len(cache['row_ids']) - 1
                 )
-                entropy = self.u_clasifications * np.log(self.u_clasifications)
-                entropy = entropy.sum(axis=1)
-                entropy *= -1
-                self.unlabeled_corpus.add_extra_info('entropy', entropy.tolist())
+                present = cache['row_ids'][positions] == row_ids
+                change[positions[present]] += row_change[present]
+            # Normalize the probabilities with the new joint likelihood,
+            # dividing both sides by the largest exponential to avoid
+            # overflows.
+            top = np.maximum(change, 0)
+            class_scale = np.exp(change - top)
+            other_scale = np.exp(-top)
+            others = np.arange(n_class) != class_number
+            norm = (posterior[:, class_number] * class_scale +
+                    posterior[:, others].sum(axis=1) * other_scale)
+            posterior[:, others] *= (other_scale / norm)[:, np.newaxis]
+            posterior[:, class_number] *= class_scale / norm
+            cache['model_version'] += 1
+        return True
+
+    def _score_unlabeled(self):
+        """Scores the unlabeled instances with the query_strategy.
+
+        The scores are stored in the extra_info of the unlabeled corpus,
+        with the name of the strategy, and calculated again only when the
+        classifier or the strategy change, or new instances are added to the
+        corpus.
 
-                self._retrained = False
-            # Select the instance
-            min_entropy = min(self.unlabeled_corpus.extra_info['entropy'])
-            return self.unlabeled_corpus.extra_info['entropy'].index(min_entropy)
+        Returns:
+            The name of the strategy.
+        """
+        # This runs before every question, so it must not read the
+        # attributes of the corpus that compact it.
+        name = self.query_strategy
+        next_row_id = self.unlabeled_corpus.next_row_id
+        key = (self.unlabeled_corpus, self.classifier,
+               getattr(self.classifier, 'model_version', None), name,
+               self.deduplicate)
+        if (key[2] is None or key != self._scores_key or
+                next_row_id != self._scored_next_row_id or
+                not self.unlabeled_corpus.has_extra_info(name)):
+            corpus, posterior, inverse = self._unlabeled_posterior()
+            scores = QUERY_STRATEGIES[name](self, corpus, posterior)
+            if inverse is not None:
+                scores = scores[inverse]
+            self.unlabeled_corpus.add_extra_info(name, scores)
+            self._instance_heap = None
+            self._scores_key = key
+            self._scored_next_row_id = next_row_id
+        return name
+
+    @_requires_training
+    def get_next_instances(self, k):
+        """Selects a batch of diverse unlabeled instances for the user.
+
+        The candidates are the batch_candidates * k instances that
+        get_next_instance would select first. The first instance of the
+        batch is the best candidate, and each of the following ones is the
+        candidate with the lowest cosine similarity to the most similar
+        instance already in the batch (greedy max-min diversity).
+
+        Args:
+            k: a positive integer. The size of the batch.
 
+        Returns:
+            A list with the row ids of at most k instances of the
+            unlabeled_corpus.
+        """
+        if len(self.unlabeled_corpus) == 0:
+            return []
+        name = self._score_unlabeled()
+        scores = self.unlabeled_corpus.extra_info[name]
+        row_ids = self.unlabeled_corpus.row_ids
+        n_candidates = min(len(scores), self.batch_candidates * k)
+        if n_candidates < len(scores):
+            candidates = np.argpartition(scores, n_candidates - 1)
+            candidates = candidates[:n_candidates]
+        else:
+            candidates = np.arange(len(scores))
+        # The candidates sorted by score, the ties by row id
+        candidates = candidates[np.lexsort((row_ids[candidates],
+                                            scores[candidates]))]
+        candidate_rows = row_ids[candidates]
+        if k >= n_candidates:
+            return candidate_rows.tolist()
+
+        instances = normalize(
+            self.unlabeled_corpus.get_instances(candidate_rows)
+        )
+        similarity = safe_sparse_dot(instances, instances.T,
+                                     dense_output=True)
+        similarity = np.asarray(similarity)
+        selected = [0]
+        max_similarity = similarity[0].copy()
+        for _ in range(k - 1):
+            max_similarity[selected] = np.inf
+            selected.append(int(max_similarity.argmin()))
+            np.maximum(max_similarity, similarity[selected[-1]],
+                       out=max_similarity)
+        return candidate_rows[selected].tolist()
+
+    @_requires_training
     def get_class_options(self):
         """Sorts a list of classes to present to the user by relevance.
 
@@ -290,9 +934,13 @@ class ActivePipeline(object):
         """
         return self.classes
 
+    @_requires_training
     def get_next_features(self, class_number):
         """Selects a  and a list of features to be sent to the oracle.
 
+        The features not asked for the class that cooccur most with it are
+        selected, and sorted by information gain.
+
         Args:
             class_number: An integer. The position of the class where the
             features will belong in the np.array self.classes.
@@ -300,18 +948,62 @@ class ActivePipeline(object):
         Returns:
             A list of features numbers of size self.number_of_features.
         """
-        # Select the positions of the features that cooccur most with the class
-        selected_f_pos = self.classifier.feature_count_[class_number].argsort()
-        # Eliminate labeled features
-        def non_seen_filter(i):
-            return not self.asked_features[class_number][i]
-        selected_f_pos = filter(non_seen_filter, selected_f_pos.tolist())
-
-        selected_f_pos = selected_f_pos[:-(self.number_of_features+1):-1]
+        selected = self._feature_candidates(class_number,
+                                            self.number_of_features)
+        selected = selected[:self.number_of_features]
         # Sort the features by IG
-        def key_fun(i): return -1*self.classifier.feat_information_gain[i]
-        selected_f_pos.sort(key=key_fun)
-        return selected_f_pos
+        information_gain = self.classifier.feat_information_gain[selected]
+        return selected[np.argsort(-information_gain,
+                                   kind='mergesort')].tolist()
+
+    def _counts_key(self):
+        """Returns a key that changes when the feature counts of the
+        classifier change.
+
+        The changes made by update_class_features only modify the boost of
+        the features, so the model versions created by them have the counts
+        of the version they were applied to.
+        """
+        version = getattr(self.classifier, 'model_version', None)
+        updates = getattr(self.classifier, 'feature_updates', {})
+        while version is not None and version - 1 in updates:
+            version -= 1
+        return (self.classifier, version)
+
+    def _feature_candidates(self, class_number, k):
+        """Returns at least k features not asked for the class, sorted by
+        their count in the class, or all of them if there are less.
+
+        A pool of 4 * k candidates of each class is selected with
+        argpartition over the counts, masking the asked features. The pool
+        is cached until the counts of the classifier change, and each call
+        only removes from it the features asked since the previous one.
+        """
+        key = self._counts_key()
+        asked = self.asked_features[class_number]
+        cached_key, candidates, complete = self._candidate_cache.get(
+            class_number, (None, None, False)
+        )
+        if key[1] is not None and cached_key == key:
+            candidates = candidates[~asked[candidates]]
+            if len(candidates) >= k or complete:
+                self._candidate_cache[class_number] = (key, candidates,
+                                                       complete)
+                return candidates
+        counts = self.classifier.feature_count_[class_number]
+        n_available = len(asked) - np.count_nonzero(asked)
+        size = min(4 * k, n_available)
+        complete = size == n_available
+        if not size:
+            candidates = np.array([], dtype=np.int64)
+        else:
+            scores = np.where(asked, -np.inf, counts)
+            candidates = np.argpartition(-scores, size - 1)[:size]
+            # Sorted by count, the ties by position
+            candidates = candidates[np.lexsort((candidates,
+                                                -counts[candidates]))]
+        self._candidate_cache[class_number] = (key, candidates, complete)
+        return candidates
 
     def evaluate_test(self):
         """Evaluates the classifier with the testing set.
@@ -319,8 +1011,7 @@ class ActivePipeline(object):
         Returns:
             The score of the classifier over the test corpus
         """
-        return self.classifier.score(self.test_corpus.instances,
-                                     self.test_corpus.primary_targets)
+        return self._evaluate_corpus(self.test_corpus)[0]
 
     def evaluate_training(self):
         """Evaluate the accuracy of the classifier with the labeled data.
@@ -329,18 +1020,70 @@ class ActivePipeline(object):
             The score of the classifier over the training corpus
         """
         # Agregamos la evidencia del usuario para evaluacion?
-        return self.classifier.score(self.training_corpus.instances,
-                                     self.training_corpus.primary_targets)
+        return self._evaluate_corpus(self.training_corpus)[0]
+
+    def _evaluation(self, corpus):
+        """Returns the CorpusEvaluation that caches the predictions of the
+        classifier over corpus."""
+        evaluation = self._evaluations.get(id(corpus))
+        if evaluation is None or evaluation.corpus is not corpus:
+            evaluation = CorpusEvaluation(corpus)
+            self._evaluations[id(corpus)] = evaluation
+        return evaluation
+
+    def _predict_corpus(self, corpus):
+        """Predicts the class of each instance of corpus, chunk by chunk.
+
+        The predictions are cached until the classifier or the corpus change.
+
+        Returns:
+            A numpy array with the predicted classes.
+        """
+        return self._evaluation(corpus).predictions(self.classifier,
+                                                    self.chunk_size)
 
+    def _evaluate_corpus(self, corpus, classifier=None):
+        """Calculates the accuracy and the confusion matrix over corpus.
+
+        Both are calculated from the cached predictions of _predict_corpus.
+
+        Args:
+            corpus: a Corpus.
+            classifier: Optional. The classifier evaluated, by default
+            self.classifier.
+
+        Returns:
+            A tuple (score, confusion_matrix). Like in
+            sklearn.metrics.confusion_matrix, the rows and columns are the
+            sorted classes present in the targets or in the predictions.
+        """
+        if classifier is None:
+            classifier = self.classifier
+        return self._evaluation(corpus).confusion_matrix(classifier,
+                                                         self.chunk_size)
+
+    def _evaluate_classifier(self, classifier):
+        """Returns a dictionary with the precisions of classifier for
+        recorded_precision."""
+        testing_precision, confusion_matrix = self._evaluate_corpus(
+            self.test_corpus, classifier
+        )
+        return {
+            'testing_precision' : testing_precision,
+            'training_precision' : self._evaluate_corpus(
+                self.training_corpus, classifier)[0],
+            'confusion_matrix': confusion_matrix
+        }
+
+    @_requires_training
     def get_report(self):
         """
         Returns:
             A sklearn.metrics.classification_report on the performance
             of the classifier over the test corpus.
         """
-        predicted_targets = self.predict(self.test_corpus.instances)
-        return classification_report(self.test_corpus.primary_targets,
-                                     predicted_targets)
+        return self._evaluation(self.test_corpus).report(self.classifier,
+                                                         self.chunk_size)
 
     def label_corpus(self):
         """Adds the user corpus to the unlabeled_corpus and saves it in a file.
@@ -351,21 +1094,16 @@ class ActivePipeline(object):
         self.unlabeled_corpus.concetenate_corpus(self.user_corpus)
         self.unlabeled_corpus.save_to_file(self.u_corpus_f)
 
+    @_requires_training
     def label_feature_corpus(self):
         """Adds user_features and asked_features in feature_corpus and saves it.
 
         The filename must be passed into the configuration under the name
         feature_corpus_f.
         """
-        self.feature_corpus = np.where(self.asked_features,
-                                       np.zeros((self.n_class, self.n_feat)),
-                                       self.feature_corpus)
-
-        self.feature_corpus = np.where(
-            self.user_features > self.alpha,
-            np.ones((self.n_class, self.n_feat)),
-            self.feature_corpus
-        )
+        self.feature_corpus = np.array(self.feature_corpus, dtype=np.int8)
+        self.feature_corpus[self.asked_features] = 0
+        self.feature_corpus[self.user_features > self.alpha] = 1
         f = open(self.feature_corpus_f, 'w')
         pickle.dump(self.feature_corpus, f)
         f.close()
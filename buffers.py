@@ -0,0 +1,440 @@
+import heapq
+import numpy as np
+
+from scipy.sparse import csr_matrix, issparse
+
+
+class GrowableArray(object):
+    """A one dimensional numpy array with amortized constant time appends.
+
+    The elements are stored in a pre-allocated buffer that doubles its
+    capacity every time it gets full. Only the first len(self) positions of
+    the buffer are meaningful, and the view method returns them without
+    copying.
+    """
+    def __init__(self, values=None, dtype=np.float64, capacity=16):
+        """
+        Args:
+            values: Optional. An array like used as initial content. If it is
+            a numpy array it is used as buffer without copying it.
+            dtype: the numpy dtype of the elements when values is not given.
+            capacity: the initial size of the buffer when values is not
+            given.
+        """
+        if values is None:
+            self._buffer = np.empty(capacity, dtype=dtype)
+            self._size = 0
+        else:
+            self._buffer = np.asarray(values)
+            self._size = self._buffer.shape[0]
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def dtype(self):
+        return self._buffer.dtype
+
+    def view(self):
+        """Returns the used part of the buffer. It is not a copy."""
+        return self._buffer[:self._size]
+
+    def reserve(self, capacity, dtype=None):
+        """Ensures the buffer can hold capacity elements without resizing.
+
+        The new size of the buffer is at least twice the previous one, so
+        a sequence of appends costs amortized constant time.
+
+        Args:
+            capacity: a non negative integer.
+            dtype: Optional. A dtype the buffer must be able to represent.
+            If it is wider than the current one the buffer is promoted.
+        """
+        new_dtype = self._buffer.dtype
+        if dtype is not None:
+            new_dtype = np.promote_types(new_dtype, dtype)
+        if capacity <= self._buffer.shape[0] and new_dtype == self.dtype:
+            return
+        new_capacity = max(capacity, 2 * self._buffer.shape[0], 16)
+        new_buffer = np.empty(new_capacity, dtype=new_dtype)
+        new_buffer[:self._size] = self.view()
+        self._buffer = new_buffer
+
+    def append(self, value):
+        self.reserve(self._size + 1, np.result_type(self.dtype, value))
+        self._buffer[self._size] = value
+        self._size += 1
+
+    def extend(self, values):
+        values = np.asarray(values)
+        self.reserve(self._size + values.shape[0], values.dtype)
+        self._buffer[self._size:self._size + values.shape[0]] = values
+        self._size += values.shape[0]
+
+    def compress(self, mask):
+        """Keeps only the elements where mask is True.
+
+        Args:
+            mask: a boolean array like of len(self).
+        """
+        self._buffer = self.view()[mask]
+        self._size = self._buffer.shape[0]
+
+
+class RaggedArray(object):
+    """A growable sequence of rows of numbers with variable length.
+
+    All the rows are stored one after the other in a single GrowableArray,
+    and indptr holds the position where each row starts, like in a csr
+    matrix.
+    """
+    def __init__(self, values=None, indptr=None, dtype=np.int32):
+        """
+        Args:
+            values: Optional. A numpy array with the concatenated rows. It is
+            used as buffer without copying it.
+            indptr: Optional. A numpy array with the start of each row plus
+            the end of the last one. Must be given with values.
+            dtype: the numpy dtype of the values when they are not given.
+        """
+        if values is None:
+            self._values = GrowableArray(dtype=dtype)
+            self._indptr = GrowableArray(np.zeros(1, dtype=np.int64))
+        else:
+            self._values = GrowableArray(values)
+            self._indptr = GrowableArray(indptr)
+
+    @classmethod
+    def from_lists(cls, rows, dtype=np.int32):
+        lengths = np.array([len(row) for row in rows], dtype=np.int64)
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        values = np.fromiter((value for row in rows for value in row),
+                             dtype=dtype, count=indptr[-1])
+        return cls(values, indptr)
+
+    def __len__(self):
+        return len(self._indptr) - 1
+
+    @property
+    def values(self):
+        return self._values.view()
+
+    @property
+    def indptr(self):
+        return self._indptr.view()
+
+    def row(self, index):
+        start, end = self._indptr.view()[index:index + 2]
+        return self._values.view()[start:end]
+
+    def append(self, row):
+        self._values.extend(np.asarray(row, dtype=self._values.dtype))
+        self._indptr.append(len(self._values))
+
+    def extend(self, other):
+        """Adds all the rows of the RaggedArray other at the end."""
+        size = len(self._values)
+        self._values.extend(other.values)
+        self._indptr.extend(other.indptr[1:] - other.indptr[0] + size)
+
+    def tolists(self):
+        values = self._values.view().tolist()
+        indptr = self._indptr.view().tolist()
+        return [values[start:end]
+                for start, end in zip(indptr[:-1], indptr[1:])]
+
+    def _row_positions(self, indexes):
+        """Returns the positions in values of the rows in indexes."""
+        indptr = self._indptr.view()
+        lengths = np.diff(indptr)[indexes]
+        starts = np.repeat(indptr[:-1][indexes] - np.cumsum(lengths) +
+                           lengths, lengths)
+        return starts + np.arange(lengths.sum()), lengths
+
+    def take(self, indexes):
+        """Returns a RaggedArray with the rows in the positions indexes."""
+        positions, lengths = self._row_positions(np.asarray(indexes))
+        indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        return RaggedArray(self._values.view()[positions], indptr)
+
+    def compress(self, mask):
+        """Keeps only the rows where mask is True."""
+        compressed = self.take(np.flatnonzero(mask))
+        self._values = compressed._values
+        self._indptr = compressed._indptr
+
+
+class LazyStringList(object):
+    """A read only sequence of strings stored in a single array of bytes.
+
+    The string i is blob[offsets[i]:offsets[i + 1]], or None if missing[i].
+    The strings marked in is_unicode were unicode strings, and are decoded
+    from utf-8 when they are read. The strings are extracted from the blob
+    when they are accessed, so the arrays can be memory mapped and never
+    fully read.
+    """
+    def __init__(self, blob, offsets, missing, rows=None, is_unicode=None):
+        """
+        Args:
+            blob: a numpy array of uint8.
+            offsets: a numpy array of integers with the start of each string
+            plus the end of the last one.
+            missing: a numpy array of booleans, True for the None values.
+            rows: Optional. A numpy array with the positions of the strings
+            in the blob that are part of the sequence.
+            is_unicode: Optional. A numpy array of booleans, True for the
+            strings that are returned as unicode. By default all of them
+            are byte strings.
+        """
+        self._blob = blob
+        self._offsets = offsets
+        self._missing = missing
+        if rows is None:
+            rows = np.arange(len(offsets) - 1)
+        self._rows = rows
+        if is_unicode is None:
+            is_unicode = np.zeros(len(missing), dtype=bool)
+        self._is_unicode = is_unicode
+
+    @classmethod
+    def from_strings(cls, strings):
+        """Builds a LazyStringList with the given strings or None values.
+
+        The unicode strings are encoded with utf-8, and any other value that
+        is not a string is converted with str.
+        """
+        missing = np.array([s is None for s in strings], dtype=bool)
+        is_unicode = np.array([isinstance(s, unicode) for s in strings],
+                              dtype=bool)
+        encoded = [s.encode('utf-8') if isinstance(s, unicode)
+                   else (s if isinstance(s, str) else str(s or ''))
+                   for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in encoded], out=offsets[1:])
+        return cls(np.frombuffer(''.join(encoded), dtype=np.uint8), offsets,
+                   missing, is_unicode=is_unicode)
+
+    def arrays(self):
+        """Returns the blob, offsets, missing and is_unicode arrays of the
+        strings."""
+        if len(self._rows) == len(self._offsets) - 1:
+            return self._blob, self._offsets, self._missing, self._is_unicode
+        return LazyStringList.from_strings(list(self)).arrays()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _get(self, row):
+        if self._missing[row]:
+            return None
+        value = self._blob[self._offsets[row]:self._offsets[row + 1]].tostring()
+        if self._is_unicode[row]:
+            return value.decode('utf-8')
+        return value
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._get(row) for row in self._rows[index]]
+        return self._get(self._rows[index])
+
+    def __iter__(self):
+        for row in self._rows:
+            yield self._get(row)
+
+    def compress(self, mask):
+        """Returns a LazyStringList with the strings where mask is True."""
+        return LazyStringList(self._blob, self._offsets, self._missing,
+                              self._rows[np.asarray(mask, dtype=bool)],
+                              self._is_unicode)
+
+
+class CSRBuffer(object):
+    """A growable csr matrix where appending rows costs amortized O(nnz).
+
+    The data, indices and indptr arrays of the matrix are kept in
+    GrowableArrays, and a scipy csr_matrix sharing those buffers is built
+    only when tocsr is called.
+
+    The indices are stored as int32, so the matrix can hold less than 2**31
+    non zero elements.
+    """
+    def __init__(self, matrix=None, n_features=None):
+        """
+        Args:
+            matrix: Optional. A matrix used as initial content. If it is a
+            csr matrix, its arrays are used as buffers without copying.
+            n_features: Optional. The number of columns of an empty buffer.
+            If it is not given it is taken from the first appended row.
+        """
+        if matrix is None:
+            self._data = GrowableArray()
+            self._indices = GrowableArray(dtype=np.int32)
+            self._indptr = GrowableArray(np.zeros(1, dtype=np.int32))
+            self._indptr.reserve(16)
+            self.n_features = n_features
+            return
+        matrix = csr_matrix(matrix)
+        # csr_matrix does not always keep sorted and canonical indices, but
+        # everything we copy from the buffer must be in the same format.
+        matrix.sum_duplicates()
+        self._data = GrowableArray(matrix.data)
+        self._indices = GrowableArray(matrix.indices.astype(np.int32,
+                                                            copy=False))
+        self._indptr = GrowableArray(matrix.indptr.astype(np.int32,
+                                                          copy=False))
+        self.n_features = matrix.shape[1]
+
+    @classmethod
+    def from_arrays(cls, data, indices, indptr, n_features):
+        """Builds a buffer over the arrays of a csr matrix without copying.
+
+        The arrays are not checked, they must represent a csr matrix with
+        sorted indices and no duplicates, and indices and indptr must be
+        int32. They can be read only (for example memory mapped), as the
+        buffer is copied the first time it needs to grow.
+        """
+        result = cls()
+        result._data = GrowableArray(data)
+        result._indices = GrowableArray(indices)
+        result._indptr = GrowableArray(indptr)
+        result.n_features = n_features
+        return result
+
+    def __len__(self):
+        return len(self._indptr) - 1
+
+    @property
+    def shape(self):
+        return (len(self), self.n_features or 0)
+
+    @property
+    def nnz(self):
+        return len(self._indices)
+
+    def append(self, row):
+        """Adds row at the end of the matrix.
+
+        Args:
+            row: a vector or a sparse matrix with a single row.
+        """
+        self.extend(row)
+
+    def extend(self, matrix):
+        """Adds all the rows of matrix at the end of the buffer.
+
+        Args:
+            matrix: an array like or sparse matrix with n_features columns.
+        """
+        if not issparse(matrix):
+            matrix = np.atleast_2d(np.asarray(matrix))
+        matrix = csr_matrix(matrix)
+        matrix.sum_duplicates()
+        if not len(self):
+            # The values of an empty buffer take the type of the first rows.
+            self._data = GrowableArray(dtype=matrix.dtype)
+        if self.n_features is None:
+            self.n_features = matrix.shape[1]
+        elif matrix.shape[1] != self.n_features:
+            raise ValueError("Expected {} features, got {}".format(
+                self.n_features, matrix.shape[1]))
+        nnz = self.nnz
+        self._data.extend(matrix.data)
+        self._indices.extend(matrix.indices.astype(np.int32, copy=False))
+        self._indptr.extend((matrix.indptr[1:] + nnz).astype(np.int32))
+
+    def row_slice(self, start, end):
+        """Returns the rows start to end - 1 as a csr_matrix.
+
+        The data and indices of the result share the memory of the buffers.
+        """
+        indptr = self._indptr.view()[start:end + 1]
+        return csr_matrix((self._data.view()[indptr[0]:indptr[-1]],
+                           self._indices.view()[indptr[0]:indptr[-1]],
+                           indptr - indptr[0]),
+                          shape=(end - start, self.n_features), copy=False)
+
+    def getrow(self, index):
+        """Returns a copy of the row index as a csr_matrix of one row."""
+        start, end = self._indptr.view()[index:index + 2]
+        return csr_matrix((self._data.view()[start:end].copy(),
+                           self._indices.view()[start:end].copy(),
+                           np.array([0, end - start], dtype=np.int32)),
+                          shape=(1, self.n_features))
+
+    def compress(self, mask):
+        """Keeps only the rows where mask is True.
+
+        Args:
+            mask: a boolean array like of len(self).
+        """
+        mask = np.asarray(mask, dtype=bool)
+        lengths = np.diff(self._indptr.view())
+        keep = np.repeat(mask, lengths)
+        self._data.compress(keep)
+        self._indices.compress(keep)
+        indptr = np.zeros(mask.sum() + 1, dtype=np.int32)
+        np.cumsum(lengths[mask], out=indptr[1:])
+        self._indptr = GrowableArray(indptr)
+
+    def tocsr(self):
+        """Returns a csr_matrix sharing the memory of the buffers."""
+        return csr_matrix((self._data.view(), self._indices.view(),
+                           self._indptr.view()), shape=self.shape, copy=False)
+
+
+class LazyHeap(object):
+    """A min heap of row ids keyed by a score, with lazy deletion.
+
+    The rows removed from the corpus are not searched in the heap, they are
+    discarded when they reach the top. Only the capacity rows with the
+    lowest scores are selected, with a partition, and heapified, so
+    building the heap costs O(n) and each pop O(log capacity). When it gets
+    empty it must be built again with the remaining rows. The ties are
+    broken by the smallest row id, also when selecting the rows.
+    """
+    def __init__(self, scores, row_ids, capacity=1024):
+        """
+        Args:
+            scores: a numpy array with the score of each row.
+            row_ids: a numpy array with the row ids.
+            capacity: Optional. The maximum number of rows in the heap.
+        """
+        scores = np.asarray(scores)
+        row_ids = np.asarray(row_ids)
+        if len(scores) > capacity:
+            # The rows with a lower score than the last selected one, and
+            # the rows tied with it that have the smallest row ids
+            last = np.partition(scores, capacity - 1)[capacity - 1]
+            best = np.flatnonzero(scores < last)
+            ties = np.flatnonzero(scores == last)
+            ties = ties[np.argsort(row_ids[ties])][:capacity - len(best)]
+            best = np.concatenate((best, ties))
+            scores, row_ids = scores[best], row_ids[best]
+        self._heap = zip(scores.tolist(), row_ids.tolist())
+        heapq.heapify(self._heap)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def peek(self, is_valid):
+        """Returns the valid row id with the lowest score.
+
+        Args:
+            is_valid: a function that receives a row id and returns False if
+            the row was removed. The removed rows are discarded.
+
+        Returns:
+            A row id, or None if there are no valid rows in the heap.
+        """
+        while self._heap and not is_valid(self._heap[0][1]):
+            heapq.heappop(self._heap)
+        return self._heap[0][1] if self._heap else None
+
+    def pop(self, is_valid):
+        """Removes and returns the valid row id with the lowest score."""
+        row_id = self.peek(is_valid)
+        if row_id is not None:
+            heapq.heappop(self._heap)
+        return row_id
@@ -1,11 +1,11 @@
+import json
+import numpy as np
+import os
 import pickle
-import random
-import scipy.sparse.csr
 
+from buffers import CSRBuffer, GrowableArray, LazyStringList, RaggedArray
 from collections import defaultdict
 from collections import Counter
-from scipy.sparse import vstack, csr_matrix
-from scipy.stats import mode
 
 
 class Corpus(object):
@@ -13,61 +13,463 @@ class Corpus(object):
 
     Attributes:
         -- instances: a scipy sparse matrix with the processed instances of the
-        corpus. Must be a csr matrix or you need to reimplement the method
-        add_instance_target.
+        corpus. The rows are stored in a CSRBuffer, so adding instances costs
+        amortized constant time, and the csr matrix is built when the
+        attribute is read. It is an empty list if the corpus has no rows.
         -- primary_targets: a vector with the most important target
         classes for each instance.
         -- full_targets: a vector with the full list of classes associated to
         each instance.
+        -- classes: the list of all the classes found in the targets. The
+        targets are stored as positions in this list (class codes), and
+        primary_targets and full_targets are decoded when they are read.
+        -- primary_target_codes: a numpy int32 array with the class code of
+        the primary target of each instance, or -1 if it has no targets.
         -- representations: a natural language representation for each of the
-        instances.
-        -- extra_info: a dictionary where the values are lists. Each list
-        represents extra information about each instance, for example, entropy.
-        The default value for each list is 0.
-
+        instances. When the corpus is loaded from a directory it is a
+        LazyStringList, that reads each representation from the file when
+        it is accessed.
+        -- extra_info: a dictionary where the values are numpy arrays. Each
+        array represents extra information about each instance, for example,
+        entropy. The default value for each array is 0. The arrays are stored
+        in GrowableArrays aligned with the rows, and the dictionary holds
+        views of them, so they can be modified in place.
+        -- members: None, or for a corpus returned by deduplicate, a
+        RaggedArray with the row ids in the original corpus of the
+        instances collapsed into each row.
+        -- version: an integer incremented each time the rows or the targets
+        of the corpus change. It can be used as key of values computed from
+        them.
+
+    Each instance also has a row id, a non negative integer that does not
+    change while the instance is in the corpus. Popping an instance only
+    marks its row as deleted, and the deleted rows are removed from the
+    buffers (compacted) when they are more than compaction_ratio of the
+    stored rows, when compact is called, or when one of the attributes above
+    is read. The methods that receive a row id (get_instance, pop_instance)
+    do not trigger a compaction.
     """
+    compaction_ratio = 0.25
+
     def __init__(self):
-        self.instances = []
-        self.representations = []
-        self.primary_targets = []
-        self.full_targets = []
+        self._instances = None
+        self._matrix = None
+        self._representations = []
+        self.classes = []
+        self._class_codes = {}
+        self._targets = RaggedArray()
+        self._primary = GrowableArray(dtype=np.int32)
         self._features_vectorizer = None
-        self.extra_info = {}
+        self._vectorizer_filename = None
+        self._feature_names = None
+        self._feature_index = None
+        self._extra_info = {}
+        self._deduplicated = {}
+        self.members = None
+        self.version = 0
+        self._reset_rows(0)
 
     def __len__(self):
-        if isinstance(self.instances, list):
-            return len(self.instances)
-        return self.instances.shape[0]
+        return len(self._active) - self._n_deleted
+
+    def __contains__(self, row_id):
+        """Returns True if there is an instance with the given row id."""
+        try:
+            self._position(row_id)
+        except IndexError:
+            return False
+        return True
+
+    def _reset_rows(self, size):
+        """Assigns the row ids 0 to size - 1 to the stored rows."""
+        self._ids = GrowableArray(np.arange(size, dtype=np.int64))
+        self._active = GrowableArray(np.ones(size, dtype=bool))
+        self._next_id = size
+        self._n_deleted = 0
+
+    def _add_rows(self, size):
+        """Assigns new row ids to size rows added at the end of the corpus."""
+        self._ids.extend(np.arange(self._next_id, self._next_id + size))
+        self._active.extend(np.ones(size, dtype=bool))
+        self._next_id += size
+
+    @property
+    def instances(self):
+        self.compact()
+        if self._instances is None:
+            return []
+        if self._matrix is None:
+            self._matrix = self._instances.tocsr()
+        return self._matrix
+
+    @instances.setter
+    def instances(self, matrix):
+        if isinstance(matrix, list) and not matrix:
+            self._instances = None
+        else:
+            self._instances = CSRBuffer(matrix)
+        self._modified()
+        self._reset_rows(len(self._instances or []))
+
+    @property
+    def representations(self):
+        self.compact()
+        return self._representations
+
+    @property
+    def primary_targets(self):
+        self.compact()
+        return [self._decode(code) for code in self._primary.view().tolist()]
+
+    @property
+    def primary_target_codes(self):
+        self.compact()
+        return self._primary.view()
+
+    @property
+    def full_targets(self):
+        self.compact()
+        return [[self.classes[code] for code in codes]
+                for codes in self._targets.tolists()]
+
+    def _decode(self, code):
+        """Returns the class with the given code, or None for -1."""
+        return self.classes[code] if code >= 0 else None
+
+    def _encode(self, targets):
+        """Returns the class codes of targets, adding new classes to the
+        vocabulary."""
+        result = []
+        for target in targets:
+            if target not in self._class_codes:
+                self._class_codes[target] = len(self.classes)
+                self.classes.append(target)
+            result.append(self._class_codes[target])
+        return result
+
+    def _set_targets(self, classes, targets):
+        """Replaces the targets and recalculates the primary targets.
+
+        Args:
+            classes: the list of classes.
+            targets: a RaggedArray with the class codes of each instance.
+        """
+        self.classes = list(classes)
+        self._class_codes = dict((c, i) for i, c in enumerate(self.classes))
+        self._targets = targets
+        self._modified()
+        self.calculate_primary_targets()
+
+    @property
+    def extra_info(self):
+        self.compact()
+        return dict((key, values.view())
+                    for key, values in self._extra_info.items())
+
+    @property
+    def next_row_id(self):
+        """The row id of the next instance added to the corpus.
+
+        Unlike row_ids, reading it does not compact the corpus.
+        """
+        return self._next_id
+
+    def has_extra_info(self, name):
+        """Returns True if extra_info has the field name, without
+        compacting the corpus."""
+        return name in self._extra_info
+
+    @property
+    def row_ids(self):
+        """A numpy array with the row id of each instance of the corpus."""
+        self.compact()
+        return self._ids.view()
+
+    def iter_chunks(self, rows=10000):
+        """Iterates over the instances in blocks of consecutive rows.
+
+        The blocks share the memory of the corpus, so the instances can be
+        processed with a bounded amount of memory.
+
+        Args:
+            rows: Optional. The maximum number of rows of each block.
+
+        Yields:
+            Tuples (start, matrix) where matrix is a csr_matrix with the
+            instances from position start.
+        """
+        self.compact()
+        for start in range(0, len(self), rows):
+            yield start, self._instances.row_slice(
+                start, min(start + rows, len(self))
+            )
+
+    def _mutable_representations(self):
+        """Returns the representations as a list that can be extended."""
+        if not isinstance(self._representations, list):
+            self._representations = list(self._representations)
+        return self._representations
+
+    def _append_rows(self, matrix):
+        """Adds the rows of matrix to the instances buffer."""
+        if self._instances is None:
+            self._instances = CSRBuffer()
+        self._instances.extend(matrix)
+        self._modified()
+
+    def _modified(self):
+        """Discards the values computed from the rows of the corpus."""
+        self._matrix = None
+        self._deduplicated.clear()
+        self.version += 1
+
+    def _position(self, row_id):
+        """Returns the position in the buffers of the row with id row_id.
+
+        Raises:
+            IndexError if there is no instance in the corpus with that id.
+        """
+        ids = self._ids.view()
+        position = ids.searchsorted(row_id)
+        if (position >= len(ids) or ids[position] != row_id or
+                not self._active.view()[position]):
+            raise IndexError('No instance with row id {}'.format(row_id))
+        return position
+
+    def compact(self):
+        """Removes the deleted rows from the buffers.
+
+        The row ids of the remaining instances are not modified.
+        """
+        if not self._n_deleted:
+            return
+        mask = self._active.view()
+        self._instances.compress(mask)
+        self._modified()
+        if isinstance(self._representations, LazyStringList):
+            self._representations = self._representations.compress(mask)
+        else:
+            self._representations = [r for r, a in
+                                     zip(self._representations, mask) if a]
+        self._targets.compress(mask)
+        self._primary.compress(mask)
+        for values in self._extra_info.values():
+            values.compress(mask)
+        self._ids.compress(mask)
+        self._active.compress(mask)
+        self._n_deleted = 0
 
     def load_from_file(self, filename):
+        """Loads the corpus from filename.
+
+        Args:
+            filename: a string. The name of a directory written by
+            save_to_file, or of a pickle file with the legacy format.
+        """
+        if os.path.isdir(filename):
+            self._load_from_directory(filename)
+            return
         f = open(filename, 'r')
-        (self.instances, self.full_targets, self.representations,
+        (self.instances, full_targets, self._representations,
             self._features_vectorizer) = pickle.load(f)
-        self.calculate_primary_targets()
         f.close()
+        self._vectorizer_filename = None
+        self._feature_names = None
+        self._feature_index = None
+        self.classes = []
+        self._class_codes = {}
+        self._set_targets(self.classes, RaggedArray.from_lists(
+            [self._encode(targets) for targets in full_targets]
+        ))
 
     def save_to_file(self, filename):
-        f = open(filename, 'w')
-        pickle.dump((self.instances, self.full_targets,
-                     self.representations, self._features_vectorizer), f)
-        f.close()
+        """Saves the corpus into the directory filename.
+
+        Each array is stored in its own .npy file, so the corpus can be
+        loaded with memory mapping:
+            -- data, indices, indptr: the arrays of the csr matrix.
+            -- target_codes, target_indptr: the position in the classes list
+            of each target, and where the targets of each instance start.
+            -- representations, representation_offsets: the utf-8 bytes of all
+            the representations and where each one starts. The None
+            representations are marked in representation_missing.
+            -- feature_names, feature_name_offsets, feature_name_missing: the
+            name of each feature, stored like the representations.
+            -- meta.json: the number of features and the list of classes.
+            -- vectorizer.pickle: the features vectorizer, if any.
+
+        If filename is an existing file, it is considered a corpus in the
+        legacy pickle format and it is overwritten with the same format. Use
+        convert_pickle_corpus to migrate it.
+        """
+        if os.path.isfile(filename):
+            f = open(filename, 'w')
+            pickle.dump((self.instances, self.full_targets,
+                         self.representations, self._get_vectorizer()), f)
+            f.close()
+            return
+        self._save_to_directory(filename)
+
+    @staticmethod
+    def _save_array(dirname, name, array):
+        """Writes array into dirname/name.npy.
+
+        The array is written in a new file that replaces the old one, so the
+        corpus that memory maps the old file can still read it.
+        """
+        filename = os.path.join(dirname, name + '.npy')
+        temporal_filename = filename + '.tmp'
+        with open(temporal_filename, 'wb') as f:
+            np.save(f, array)
+        os.rename(temporal_filename, filename)
+
+    def _save_to_directory(self, dirname):
+        self.compact()
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        if len(self):
+            matrix = self.instances
+        else:
+            matrix = CSRBuffer(n_features=getattr(self._instances,
+                                                  'n_features', 0)).tocsr()
+        self._save_array(dirname, 'data', matrix.data)
+        self._save_array(dirname, 'indices',
+                         matrix.indices.astype(np.int32, copy=False))
+        self._save_array(dirname, 'indptr',
+                         matrix.indptr.astype(np.int32, copy=False))
+
+        self._save_array(dirname, 'target_codes', self._targets.values)
+        self._save_array(dirname, 'target_indptr', self._targets.indptr)
+
+        representations = self._representations
+        if not isinstance(representations, LazyStringList):
+            representations = LazyStringList.from_strings(representations)
+        self._save_strings(dirname, 'representation', representations)
+        feature_names = self._get_feature_names()
+        if feature_names is not None:
+            self._save_strings(dirname, 'feature_name', feature_names)
+
+        # JSON reads every string as unicode, so the positions of the byte
+        # string classes are kept to encode them again when loading
+        meta = {'n_features': matrix.shape[1],
+                'classes': self.classes,
+                'byte_classes': [i for i, c in enumerate(self.classes)
+                                 if isinstance(c, str)]}
+        with open(os.path.join(dirname, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        vectorizer = self._get_vectorizer()
+        if vectorizer is not None:
+            with open(os.path.join(dirname, 'vectorizer.pickle'), 'w') as f:
+                pickle.dump(vectorizer, f)
+
+    def _save_strings(self, dirname, name, strings):
+        """Writes the arrays of the LazyStringList strings."""
+        blob, offsets, missing, is_unicode = strings.arrays()
+        self._save_array(dirname, name + 's', blob)
+        self._save_array(dirname, name + '_offsets', offsets)
+        self._save_array(dirname, name + '_missing', missing)
+        self._save_array(dirname, name + '_unicode', is_unicode)
+
+    def _load_strings(self, dirname, name):
+        """Returns a LazyStringList with the arrays written by _save_strings.
+        """
+        def load(suffix):
+            return np.load(os.path.join(dirname, name + suffix + '.npy'),
+                           mmap_mode='r')
+
+        is_unicode = None
+        if os.path.isfile(os.path.join(dirname, name + '_unicode.npy')):
+            is_unicode = load('_unicode')
+        return LazyStringList(load('s'), load('_offsets'), load('_missing'),
+                              is_unicode=is_unicode)
+
+    def _load_from_directory(self, dirname):
+        def load(name):
+            return np.load(os.path.join(dirname, name + '.npy'), mmap_mode='r')
+
+        with open(os.path.join(dirname, 'meta.json')) as f:
+            meta = json.load(f)
+        self._instances = CSRBuffer.from_arrays(
+            load('data'), load('indices'), load('indptr'), meta['n_features']
+        )
+        self._modified()
+        self._reset_rows(len(self._instances))
+
+        classes = meta['classes']
+        for i in meta.get('byte_classes', []):
+            classes[i] = classes[i].encode('utf-8')
+        self._set_targets(classes, RaggedArray(
+            load('target_codes'), load('target_indptr')
+        ))
+
+        self._representations = self._load_strings(dirname, 'representation')
+        self._feature_names = None
+        self._feature_index = None
+        if os.path.isfile(os.path.join(dirname, 'feature_names.npy')):
+            self._feature_names = self._load_strings(dirname, 'feature_name')
+
+        # The vectorizer is only unpickled if it is needed
+        self._features_vectorizer = None
+        self._vectorizer_filename = os.path.join(dirname, 'vectorizer.pickle')
+        if not os.path.isfile(self._vectorizer_filename):
+            self._vectorizer_filename = None
+        self._extra_info = {}
 
     def calculate_primary_targets(self):
         """Selects the primary target for each instance from self.full_targets.
 
         The primary target is the one that most occur, or the first one if all
-        the elements occur the same number of times.
-        """
-        self.primary_targets = []
-        for targets in self.full_targets:
-            if not targets:
-                self.primary_targets.append(None)
-                continue
-            m = mode(targets)
-            if m[1][0] != 1:
-                self.primary_targets.append(m[0])
-            else:
-                self.primary_targets.append(targets[0])
+        the elements occur the same number of times. The most frequent target
+        of every instance is found at once, counting the (instance, class)
+        pairs of the flattened class codes.
+        """
+        codes = self._targets.values.astype(np.int64)
+        lengths = np.diff(self._targets.indptr)
+        n_classes = max(len(self.classes), 1)
+        pairs = np.repeat(np.arange(len(lengths)), lengths) * n_classes + codes
+        pairs, first, counts = np.unique(pairs, return_index=True,
+                                         return_counts=True)
+        pair_rows = pairs // n_classes
+        # For each instance, the most frequent class and then the first one
+        order = np.lexsort((first, -counts, pair_rows))
+        pair_rows = pair_rows[order]
+        is_best = np.ones(len(order), dtype=bool)
+        is_best[1:] = pair_rows[1:] != pair_rows[:-1]
+        primary = np.full(len(lengths), -1, dtype=np.int32)
+        primary[pair_rows[is_best]] = codes[first[order][is_best]]
+        self._primary = GrowableArray(primary)
+
+    @staticmethod
+    def _primary_code(codes):
+        """Returns the primary target of a single list of class codes."""
+        if not codes:
+            return -1
+        counts = Counter(codes)
+        return max(codes, key=lambda code: counts[code])
+
+    def _get_vectorizer(self):
+        """Returns the features vectorizer, unpickling it if needed."""
+        if self._features_vectorizer is None and self._vectorizer_filename:
+            with open(self._vectorizer_filename, 'r') as f:
+                self._features_vectorizer = pickle.load(f)
+        return self._features_vectorizer
+
+    def _get_feature_names(self):
+        """Returns a LazyStringList with the name of each feature.
+
+        The list is loaded from the corpus directory, or built with the
+        vectorizer the first time it is needed. If there is no vectorizer,
+        returns None.
+        """
+        if self._feature_names is None:
+            vectorizer = self._get_vectorizer()
+            if vectorizer is None or self._instances is None:
+                return None
+            self._feature_names = LazyStringList.from_strings(
+                [vectorizer.column_to_feature(index)[1]
+                 for index in range(self._instances.n_features)]
+            )
+        return self._feature_names
 
     def get_feature_name(self, feat_index):
         """Gives the natural language representation of a feature.
@@ -78,7 +480,34 @@ class Corpus(object):
         Returns:
             The name of the feature represented by index feat_index.
         """
-        return self._features_vectorizer.column_to_feature(feat_index)[1]
+        return self._get_feature_names()[feat_index]
+
+    def get_feature_names(self, feat_indexes):
+        """Gives the natural language representation of several features.
+
+        Args:
+            feat_indexes: a list of non negative intergers less than
+            instances.shape[1]
+
+        Returns:
+            A list with the names of the features.
+        """
+        feature_names = self._get_feature_names()
+        return [feature_names[index] for index in feat_indexes]
+
+    def get_feature_index(self, feature_name):
+        """Returns the column of the feature with name feature_name.
+
+        Returns:
+            A non negative integer, or None if there is no feature with that
+            name.
+        """
+        if self._feature_index is None:
+            self._feature_index = dict(
+                (name, index)
+                for index, name in enumerate(self._get_feature_names())
+            )
+        return self._feature_index.get(feature_name)
 
     def add_instance(self, instance, target, representation=None):
         """Adds the given instance, target and representation to the corpus.
@@ -88,69 +517,117 @@ class Corpus(object):
             target: a list of string representing the classes.
             representation: a string
         """
-        if isinstance(self.instances, scipy.sparse.csr.csr_matrix):
-            instance = csr_matrix(instance)
-            self.instances = vstack((self.instances, instance), format='csr')
-        else:
-            self.instances = csr_matrix(instance)
-        self.full_targets.append(target)
-        self.representations.append(representation)
-        if target:
-            if mode(target)[1][0] != 1:
-                self.primary_targets.append(mode(target)[0][0])
-            else:
-                self.primary_targets.append(target[0])
-        else:
-            self.primary_targets.append(None)
+        self._append_rows(instance)
+        self._add_rows(1)
+        codes = self._encode(target or [])
+        self._targets.append(codes)
+        self._mutable_representations().append(representation)
+        self._primary.append(self._primary_code(codes))
 
-        for key in self.extra_info:
-            self.extra_info[key].append(0)
+        for values in self._extra_info.values():
+            values.append(0)
 
-    def add_extra_info(self, name, values=None):
+    def add_extra_info(self, name, values=None, dtype=np.float64):
         """Appends a field into the extra_info dictionary with values.
 
         If there is a field with that name in extra info, it will be replaced.
 
         Args:
             name: a string. It will be the key of the extra_info dictionary.
-            values: a list. The len of values must be the same as the len of the
-            corpus. If values is not provided, the extra_info field will be
-            assigned to a list of 0 of correct len.
+            values: an array like. The len of values must be the same as the
+            len of the corpus. A numpy array is stored without copying it. If
+            values is not provided, the extra_info field will be assigned to
+            an array of 0 of correct len.
+            dtype: Optional. The type of the array of 0 when values is not
+            provided.
 
         Returns:
             True in case of success, False in case of error.
         """
-        if not values:
-            self.extra_info[name] = [0] * len(self)
-        elif isinstance(values, list) and len(values) == len(self):
-            self.extra_info[name] = values
-        else:
+        self.compact()
+        if values is None:
+            values = np.zeros(len(self), dtype=dtype)
+        values = np.asarray(values)
+        if values.shape != (len(self),):
             return False
+        self._extra_info[name] = GrowableArray(values)
         return True
 
-    def pop_instance(self, index):
-        """Deletes the instance and returns a copy.
+    def argmin_extra_info(self, name):
+        """Returns the row id of the instance with minimum extra_info[name].
+
+        Returns:
+            A row id, or None if the corpus is empty.
+        """
+        if not len(self):
+            return None
+        values = self._extra_info[name].view()
+        if self._n_deleted:
+            values = np.where(self._active.view(), values, np.inf)
+        return self._ids.view()[values.argmin()]
+
+    def get_instance(self, row_id):
+        """Returns a copy of the instance with the given row id.
 
         Returns:
             A tuple where the first element is the instances, the second
             element is the list of targets and the third element is the
             representation.
         """
-        row = self.instances.getrow(index)
-        m1 = self.instances[:index]
-        m2 = self.instances[index+1:]
-        if m1.shape[0] and m2.shape[0]:
-            self.instances = vstack((m1, m2), format='csr')
-        elif m1.shape[0]:
-            self.instances = m1
-        else:
-            self.instances = m2
-        target = self.full_targets.pop(index)
-        representation = self.representations.pop(index)
-        self.primary_targets.pop(index)
-        for _, v in self.extra_info.items():
-            v.pop(index)
-        return (row, target, representation)
+        position = self._position(row_id)
+        return (self._instances.getrow(position),
+                [self.classes[code] for code in self._targets.row(position)],
+                self._representations[position])
+
+    def get_instances(self, row_ids):
+        """Returns the instances with the given row ids.
+
+        Args:
+            row_ids: an array like of row ids.
+
+        Returns:
+            A csr_matrix with a row for each row id, in the same order.
+
+        Raises:
+            IndexError if some row id is not in the corpus.
+        """
+        row_ids = np.asarray(row_ids, dtype=np.int64)
+        if self._instances is None:
+            if len(row_ids):
+                raise IndexError('No instance with row id {}'.format(
+                    row_ids[0]))
+            return []
+        ids = self._ids.view()
+        positions = np.minimum(ids.searchsorted(row_ids), len(ids) - 1)
+        found = (ids[positions] == row_ids) & self._active.view()[positions]
+        if not found.all():
+            raise IndexError('No instance with row id {}'.format(
+                row_ids[~found][0]))
+        return self._instances.tocsr()[positions]
+
+    def get_primary_target(self, row_id):
+        """Returns the primary target of the instance with the given row id.
+        """
+        return self._decode(self._primary.view()[self._position(row_id)])
+
+    def pop_instance(self, row_id):
+        """Deletes the instance with the given row id and returns a copy.
+
+        The row is only marked as deleted, so this takes constant time unless
+        the deleted rows exceed compaction_ratio and the corpus is compacted.
+
+        Returns:
+            A tuple where the first element is the instances, the second
+            element is the list of targets and the third element is the
+            representation.
+        """
+        result = self.get_instance(row_id)
+        self._active.view()[self._position(row_id)] = False
+        self._n_deleted += 1
+        self._modified()
+        if self._n_deleted > self.compaction_ratio * len(self._active):
+            self.compact()
+        return result
 
     def concetenate_corpus(self, new_corpus):
         """Adds all the elements of new_corpus into the current corpus.
@@ -164,24 +641,27 @@ class Corpus(object):
             new_corpus: an instance of Corpus. It must have the same amount
             of features and be obtained by the same vectorizer object.
         """
-        if (isinstance(self.instances, scipy.sparse.csr.csr_matrix)
-            and isinstance(new_corpus.instances, scipy.sparse.csr.csr_matrix)):
-            self.instances = vstack((self.instances, new_corpus.instances),
-                                    format='csr')
-        elif isinstance(new_corpus.instances, scipy.sparse.csr.csr_matrix):
-            self.instances = new_corpus.instances
-        self.full_targets += new_corpus.full_targets
-        self.representations += new_corpus.representations
-        self.primary_targets += new_corpus.primary_targets
-        for k in self.extra_info:
-            if not k in new_corpus.extra_info:
-                self.extra_info[k] += [0] * len(new_corpus)
+        if len(new_corpus):
+            self._append_rows(new_corpus.instances)
+        self._add_rows(len(new_corpus))
+        # Translate the class codes of new_corpus to the codes of self
+        translation = np.array(self._encode(new_corpus.classes) + [-1],
+                               dtype=np.int32)
+        new_targets = new_corpus._targets.take(np.arange(len(new_corpus)))
+        new_targets.values[:] = translation[new_targets.values]
+        self._targets.extend(new_targets)
+        self._primary.extend(translation[new_corpus.primary_target_codes])
+        self._mutable_representations().extend(new_corpus.representations)
+        new_extra_info = new_corpus.extra_info
+        for k, values in self._extra_info.items():
+            if not k in new_extra_info:
+                values.extend(np.zeros(len(new_corpus), dtype=values.dtype))
             else:
-                self.extra_info[k] += new_corpus.extra_info[k]
+                values.extend(new_extra_info[k])
 
     def check_consistency(self):
-        len_components = (self.instances.shape[0] == len(self.full_targets) ==
-                          len(self.primary_targets) ==
+        len_components = (self.instances.shape[0] == len(self._targets) ==
+                          len(self.primary_target_codes) ==
                           len(self.representations))
         len_extra_info = reduce(lambda x, y: x and y,
                                 [len(self.primary_targets) == len(i)
@@ -199,35 +679,162 @@ class Corpus(object):
         """
         return Counter(self.primary_targets)
 
-    def split(self, partition_sizes):
+    def subset(self, indexes):
+        """Returns a new Corpus with the instances in the given positions.
+
+        The instances and targets are selected with a single fancy indexing
+        of their arrays.
+
+        Args:
+            indexes: an array like of non negative integers less than
+            len(self).
+        """
+        indexes = np.asarray(indexes, dtype=np.int64)
+        new_corpus = Corpus()
+        if self._instances is None:
+            # A corpus without rows can only give empty subsets
+            return new_corpus
+        new_corpus.instances = self.instances[indexes]
+        new_corpus.classes = list(self.classes)
+        new_corpus._class_codes = dict(self._class_codes)
+        new_corpus._targets = self._targets.take(indexes)
+        new_corpus._primary = GrowableArray(self._primary.view()[indexes])
+        new_corpus._representations = [self._representations[i]
+                                       for i in indexes]
+        new_corpus._features_vectorizer = self._features_vectorizer
+        new_corpus._vectorizer_filename = self._vectorizer_filename
+        new_corpus._feature_names = self._feature_names
+        new_corpus._feature_index = self._feature_index
+        return new_corpus
+
+    def deduplicate(self, by_target=False):
+        """Collapses the identical instances of the corpus into one row.
+
+        The rows are hashed with their number of non zero elements and two
+        random projections, and the rows with the same hash are compared
+        element by element, so a collision never merges different rows.
+        The result is cached until the corpus is modified.
+
+        Args:
+            by_target: Optional. If True, only the identical instances with
+            the same primary target are collapsed.
+
+        Returns:
+            A tuple (corpus, inverse). The corpus has one instance for each
+            group of identical rows, with the targets and representation of
+            its first member, the number of members in extra_info['weight']
+            and their row ids in the attribute members. inverse is a numpy
+            array with the position in corpus of each instance of self.
+        """
+        self.compact()
+        if by_target in self._deduplicated:
+            return self._deduplicated[by_target]
+        if self._instances is None:
+            result = Corpus()
+            result.add_extra_info('weight')
+            result.members = RaggedArray(dtype=np.int64)
+            return result, np.array([], dtype=np.int64)
+        matrix = self.instances
+        lengths = np.diff(matrix.indptr)
+        projection = np.random.RandomState(0).uniform(
+            -1, 1, size=(matrix.shape[1], 2))
+        projection = np.asarray(matrix.dot(projection))
+        keys = [projection[:, 1], projection[:, 0], lengths]
+        if by_target:
+            keys.append(self._primary.view())
+        order = np.lexsort(keys)
+        keys = np.column_stack(keys)[order]
+        same = np.zeros(len(order), dtype=bool)
+        same[1:] = (keys[1:] == keys[:-1]).all(axis=1)
+
+        # Compare the candidates with the previous row in the hash order
+        candidates = np.flatnonzero(same)
+        current = order[candidates]
+        previous = order[candidates - 1]
+        indptr = matrix.indptr.astype(np.int64)
+        entries = []
+        for values in (matrix.indices, matrix.data):
+            values = RaggedArray(values, indptr)
+            entries.append(values.take(current).values !=
+                           values.take(previous).values)
+        different = np.bincount(
+            np.repeat(np.arange(len(candidates)), lengths[current]),
+            weights=entries[0] | entries[1], minlength=len(candidates)
+        )
+        same[candidates[different > 0]] = False
+
+        # Number the groups in order of their first member
+        group = np.empty(len(order), dtype=np.int64)
+        group[order] = np.cumsum(~same) - 1
+        first = order[~same]
+        by_first = np.argsort(first)
+        renumber = np.empty(len(first), dtype=np.int64)
+        renumber[by_first] = np.arange(len(first))
+        inverse = renumber[group]
+        counts = np.bincount(inverse, minlength=len(first))
+
+        result = self.subset(first[by_first])
+        result.add_extra_info('weight', counts.astype(np.float64))
+        indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        result.members = RaggedArray(
+            self.row_ids[np.argsort(inverse, kind='mergesort')], indptr
+        )
+        self._deduplicated[by_target] = (result, inverse)
+        return result, inverse
+
+    def _stratified_order(self, permutation):
+        """Sorts permutation so that every slice keeps the class distribution.
+
+        The instances of each class are spread evenly along the result, using
+        the position of the instance inside its class divided by the size of
+        the class as sorting key.
+        """
+        # The instances without targets (code -1) are a class too
+        codes = self.primary_target_codes[permutation] + 1
+        by_class = np.argsort(codes, kind='mergesort')
+        codes = codes[by_class]
+        counts = np.bincount(codes)
+        rank = np.arange(len(codes)) - (counts.cumsum() - counts)[codes]
+        key = (rank + 0.5) / counts[codes]
+        return permutation[by_class][np.argsort(key, kind='mergesort')]
+
+    def split(self, partition_sizes, seed=None, stratified=False):
         """Returns Corpus instances of the given sizes randomly selected.
 
         Args:
             partition_sizes: a list of integers. Each number represents
             the size of one Corpus instance.
+            seed: Optional. An integer used to initialize the random number
+            generator.
+            stratified: Optional. If True, the distribution of the primary
+            targets in each partition is approximately the same than in the
+            whole corpus.
 
         Returns:
             A list of Corpus instances. If the size of the partitions exceeds
             the total size of the corpus, None will be returned.
         """
-        result = []
-
         total = sum(partition_sizes)
-        try:
-            selected_indexes = random.sample(range(len(self)), total)
-        except ValueError:
+        if total > len(self):
             return None
-        random.shuffle(selected_indexes)
-        last_position = 0
-        for size in partition_sizes:
-            new_corpus = Corpus()
-            for index in selected_indexes[last_position:last_position+size]:
-                new_corpus.add_instance(self.instances[index],
-                                        self.full_targets[index],
-                                        self.representations[index])
-            new_corpus.calculate_primary_targets()
-            result.append(new_corpus)
-            last_position += size
+        selected_indexes = np.random.RandomState(seed).permutation(len(self))
+        if stratified:
+            selected_indexes = self._stratified_order(selected_indexes)
+        limits = np.cumsum(partition_sizes)
+        return [self.subset(selected_indexes[end - size:end])
+                for size, end in zip(partition_sizes, limits)]
 
-        return result
 
+def convert_pickle_corpus(pickle_filename, dirname):
+    """Converts a corpus in the legacy pickle format to a corpus directory.
+
+    Args:
+        pickle_filename: a string. The name of the file to read.
+        dirname: a string. The name of the directory to write. It is
+        created if it does not exist.
+    """
+    corpus = Corpus()
+    corpus.load_from_file(pickle_filename)
+    corpus.save_to_file(dirname)
+    return corpus
@@ -1,8 +1,12 @@
+import numpy as np
+
 from featmultinomial import FeatMultinomialNB
 
 
 default_config = {
-    # Corpus files
+    # Corpus files. Each one can also be a directory written by
+    # Corpus.save_to_file, that is loaded without reading all of it. The
+    # pickle files can be converted with corpus.convert_pickle_corpus.
     'u_corpus_f': 'corpus/unlabeled_new_corpus.pickle',
     'test_corpus_f': 'corpus/test_new_corpus.pickle',
     'training_corpus_f': 'corpus/training_new_corpus.pickle',
@@ -20,6 +24,19 @@ default_config = {
 
     # Active learning instance selection function
     'get_next_instance': None,
+    # Name of the strategy that scores the unlabeled instances, one of
+    # query_strategies.STRATEGIES: 'entropy', 'least_confidence', 'margin',
+    # 'vote_entropy' or 'expected_error_reduction'
+    'query_strategy': 'entropy',
+    # Number of classifiers in the committee of vote_entropy
+    'committee_size': 3,
+    # Number of candidates evaluated by expected_error_reduction
+    'eer_subsample': 100,
+    # Number of instances asked between trainings by instance_bootstrap,
+    # and number of candidates per instance of the batch among which the
+    # most diverse instances are selected
+    'instance_batch_size': 1,
+    'batch_candidates': 10,
     # Active learning feature selection functions
     'get_next_features': None,
     'handle_feature_prediction': None,
@@ -27,5 +44,32 @@ default_config = {
     'get_class_options': None,
 
     # Run expectation maximization algorithm after training
-    'can_run_em': False
+    'can_run_em': False,
+    # Maximum number of iterations of expectation maximization, and minimum
+    # relative change of the log likelihood to keep iterating
+    'em_max_iterations': 10,
+    'em_tolerance': 1e-4,
+    # Weight of the unlabeled corpus in the estimation of the parameters.
+    # The labeled corpus has weight 1 - em_unlabeled_weight.
+    'em_unlabeled_weight': 0.1,
+    # Number of processes that classify the unlabeled corpus during
+    # expectation maximization
+    'em_processes': 1,
+
+    # Train the classifier when it is first needed, not in the constructor
+    'defer_training': False,
+
+    # Floating point type of the probabilities of the classifier, the
+    # feature boosts and the EM sums. np.float32 halves their memory.
+    'dtype': np.float64,
+
+    # Maximum number of instances classified at once
+    'chunk_size': 10000,
+
+    # Add only the new user instances to the classifier when it is trained
+    # again, instead of fitting it with all the instances
+    'incremental_training': True,
+
+    # Collapse the identical instances of the corpora into weighted rows
+    'deduplicate': False,
 }
@@ -0,0 +1,83 @@
+import numpy as np
+
+from sklearn.metrics import classification_report, confusion_matrix
+
+
+class CorpusEvaluation(object):
+    """The predictions of a classifier over a corpus and the metrics
+    derived from them.
+
+    The corpus is classified with predict_log_proba, chunk by chunk, and the
+    predicted classes are kept until the corpus or the classifier change, so
+    the score, confusion matrix and report of the same model classify the
+    corpus only once. The classifier is considered unchanged while its
+    model_version attribute is the same. For classifiers without that
+    attribute the predictions are not cached.
+    """
+    def __init__(self, corpus):
+        """
+        Args:
+            corpus: the Corpus to evaluate.
+        """
+        self.corpus = corpus
+        self._key = None
+        self._predictions = None
+        self._targets_version = None
+        self._targets = None
+
+    def targets(self):
+        """Returns a list with the primary target of each instance."""
+        if self._targets_version != self.corpus.version:
+            self._targets = self.corpus.primary_targets
+            self._targets_version = self.corpus.version
+        return self._targets
+
+    def predictions(self, classifier, chunk_size=10000):
+        """Returns a numpy array with the class predicted for each instance.
+
+        Args:
+            classifier: a fitted classifier with predict_log_proba.
+            chunk_size: Optional. The maximum number of instances classified
+            at once.
+        """
+        key = (classifier, getattr(classifier, 'model_version', None),
+               self.corpus.version)
+        if key[1] is None or key != self._key:
+            positions = [
+                classifier.predict_log_proba(instances).argmax(axis=1)
+                for _, instances in self.corpus.iter_chunks(chunk_size)
+            ]
+            if positions:
+                self._predictions = classifier.classes_[
+                    np.concatenate(positions)
+                ]
+            else:
+                self._predictions = np.array([])
+            self._key = key
+        return self._predictions
+
+    def confusion_matrix(self, classifier, chunk_size=10000):
+        """Calculates the accuracy and the confusion matrix of classifier.
+
+        Returns:
+            A tuple (score, confusion_matrix). Like in
+            sklearn.metrics.confusion_matrix, the rows and columns are the
+            sorted classes present in the targets or in the predictions.
+        """
+        predictions = self.predictions(classifier, chunk_size)
+        if not len(predictions):
+            return 0.0, np.zeros((0, 0), dtype=np.int64)
+        targets = self.targets()
+        labels = sorted(set(predictions.tolist()) | set(targets))
+        counts = confusion_matrix(targets, predictions, labels=labels)
+        return float(np.trace(counts)) / counts.sum(), counts
+
+    def score(self, classifier, chunk_size=10000):
+        """Returns the accuracy of classifier over the corpus."""
+        return self.confusion_matrix(classifier, chunk_size)[0]
+
+    def report(self, classifier, chunk_size=10000):
+        """Returns the sklearn.metrics.classification_report of classifier.
+        """
+        return classification_report(self.targets(),
+                                     self.predictions(classifier, chunk_size))
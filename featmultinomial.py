@@ -1,12 +1,71 @@
 import numpy as np
 from math import log
+from scipy.sparse import csr_matrix
+from scipy.special import logsumexp, xlogy
 from sklearn.naive_bayes import MultinomialNB
 from sklearn.utils.extmath import safe_sparse_dot
 
 
 class FeatMultinomialNB(MultinomialNB):
     """A MultinomialNB classifier that can be trained using labeled features.
+
+    The attribute model_version is incremented each time class_log_prior_ or
+    feature_log_prob_ change, and is used as key of the values cached from
+    them. When a row of feature_log_prob_ is changed by update_class_features,
+    the change is also stored in the dictionary feature_updates, with the
+    version it was applied to as key, so the cached values can be updated
+    instead of calculated again. Any other change clears feature_updates.
     """
+    model_version = 0
+
+    def __init__(self, alpha=1.0, fit_prior=True, class_prior=None,
+                 dtype=np.float64):
+        """
+        Parameters
+        ----------
+        dtype : numpy floating point type, optional (default=np.float64)
+            The type of class_log_prior_ and feature_log_prob_. The counts
+            are always float64.
+
+        The other parameters are the ones of MultinomialNB.
+        """
+        super(FeatMultinomialNB, self).__init__(alpha=alpha,
+                                                fit_prior=fit_prior,
+                                                class_prior=class_prior)
+        self.dtype = dtype
+
+    def _model_changed(self, update=None):
+        """Increments model_version.
+
+        Parameters
+        ----------
+        update : tuple, optional
+            The change made by update_class_features, stored in
+            feature_updates. If it is not given, feature_updates is cleared.
+        """
+        if update is None:
+            self.feature_updates = {}
+        else:
+            self.feature_updates = getattr(self, 'feature_updates', {})
+            self.feature_updates[self.model_version] = update
+        self.model_version += 1
+
+    def _get_class_log_prior(self):
+        return self._class_log_prior
+
+    def _set_class_log_prior(self, value):
+        self._class_log_prior = np.asarray(value, dtype=self.dtype)
+        self._model_changed()
+
+    def _get_feature_log_prob(self):
+        return self._feature_log_prob
+
+    def _set_feature_log_prob(self, value):
+        self._feature_log_prob = np.asarray(value, dtype=self.dtype)
+        self._model_changed()
+
+    class_log_prior_ = property(_get_class_log_prior, _set_class_log_prior)
+    feature_log_prob_ = property(_get_feature_log_prob, _set_feature_log_prob)
 
     def fit(self, X, Y, sample_weight=None, features=None):
         """Fit Naive Bayes classifier according to X, y
@@ -33,35 +92,243 @@ class FeatMultinomialNB(MultinomialNB):
             Returns self.
         """
         if features is not None:
-            self.alpha = features
-        self.instance_num = X.shape[0]
+            self.alpha = np.array(features)
+        if sample_weight is not None:
+            self.instance_num = np.sum(sample_weight)
+        else:
+            self.instance_num = X.shape[0]
+        self.count_feat_and_class = 0
+        self._cooccurrence_sums = None
         return_value = super(FeatMultinomialNB, self).fit(X, Y, sample_weight)
         self._information_gain()
         return return_value
 
+    def partial_fit(self, X, Y, classes=None, sample_weight=None,
+                    features=None):
+        """Incremental fit on a batch of samples.
+
+        Only the counts of the instances in X are calculated and added to
+        the counts of the previous calls, so the cost depends on the size
+        of X and not on the number of instances seen before. The
+        probabilities and the information gain are then updated from the
+        accumulated counts.
+
+        Parameters
+        ----------
+        X : {array-like, sparse matrix}, shape = [n_samples, n_features]
+            Training vectors. If n_samples is 0, the counts are not modified
+            and only the probabilities are updated, for example to use new
+            features.
+
+        y : array-like, shape = [n_samples]
+            Target values. The classes unknown to the classifier are ignored.
+
+        classes : array-like, shape = [n_classes], optional
+            List of all the classes that can possibly appear in the y vector.
+            Must be provided at the first call, if fit was not called before.
+
+        sample_weight : array-like, shape = [n_samples], optional
+            Weights applied to individual samples (1. for unweighted).
+
+        features : array-like, shape = [n_classes, n_features], optional
+            Boost for the prior probability of a feature given a class.
+
+        Returns
+        -------
+        self : object
+            Returns self.
+        """
+        if features is not None:
+            self.alpha = np.array(features)
+        if getattr(self, 'classes_', None) is None:
+            self.instance_num = 0
+            self.count_feat_and_class = 0
+            self._cooccurrence_sums = None
+        if X.shape[0]:
+            if sample_weight is not None:
+                self.instance_num += np.sum(sample_weight)
+            else:
+                self.instance_num += X.shape[0]
+            super(FeatMultinomialNB, self).partial_fit(X, Y, classes,
+                                                       sample_weight)
+            self._information_gain()
+        else:
+            self._update_feature_log_prob()
+            self._update_class_log_prior(class_prior=self.class_prior)
+        return self
+
+    def update_class_features(self, class_number, features):
+        """Changes the boost of the features of a single class.
+
+        Only the row class_number of feature_log_prob_ is calculated again.
+        The information gain depends on the counts and not on the boost, so
+        it does not change.
+
+        If the previous row was calculated from the counts, the change is
+        stored in feature_updates as a tuple (class_number, columns,
+        column_change, shift): the row changes by column_change in the
+        positions columns, where the boost changed, and by shift, the change
+        of the normalization, in all the other positions.
+
+        Parameters
+        ----------
+        class_number : integer
+            The position of the class in self.classes_.
+
+        features : array-like, shape = [n_features]
+            The new boost for the prior probability of each feature given the
+            class.
+        """
+        if np.ndim(self.alpha) != 2:
+            self.alpha = np.full(self.feature_count_.shape, self.alpha,
+                                 dtype=np.float64)
+        old_smoothed_fc = self.feature_count_[class_number] + \
+            self.alpha[class_number]
+        old_row = self.feature_log_prob_[class_number]
+        smoothed_fc = self.feature_count_[class_number] + features
+        new_row = (np.log(smoothed_fc) -
+                   np.log(smoothed_fc.sum())).astype(old_row.dtype)
+        update = None
+        if np.allclose(old_row, np.log(old_smoothed_fc) -
+                       np.log(old_smoothed_fc.sum())):
+            columns = np.flatnonzero(self.alpha[class_number] != features)
+            update = (class_number, columns,
+                      new_row[columns] - old_row[columns],
+                      np.log(old_smoothed_fc.sum()) -
+                      np.log(smoothed_fc.sum()))
+        self.alpha[class_number] = features
+        self.feature_log_prob_[class_number] = new_row
+        self._model_changed(update)
+
     def _count(self, X, Y):
         super(FeatMultinomialNB, self)._count(X, Y)
         # Number of instances with class j and presence of feature k
-        # shape class, feat.
-        self.count_feat_and_class = safe_sparse_dot(Y.T, (X > 0))
+        # shape class, feat. Only the non zero elements are added.
+        if np.ndim(self.count_feat_and_class) != 2:
+            self.count_feat_and_class = np.zeros(self.feature_count_.shape)
+        presence = (csr_matrix(Y.T) * csr_matrix(X > 0)).tocoo()
+        self.count_feat_and_class[presence.row, presence.col] += presence.data
+        self._changed_classes = np.flatnonzero(Y.sum(axis=0))
 
     def _information_gain(self):
         """Calculates the information gain for each feature.
 
         Stores the value in self.feat_information_gain
+
+        With n1 = count_feat_and_class[c, k], n0 = class_count_[c] - n1 and
+        m1, m0 the sums of n1 and n0 over the classes, the information gain
+        of the feature k multiplied by instance_num is
+            sum_c(n1 log n1 + n0 log n0 - class_count_[c] log class_count_[c])
+            + sum_c(class_count_[c] log class_count_[c])
+            - m1 log m1 - m0 log (instance_num - m1)
+            - sum_c(class_count_[c] * class_log_prior_[c])
+        The terms of the first sum are 0 for the classes where the feature
+        never occurs, so it is calculated only with the non zero elements of
+        count_feat_and_class. The sums of each feature are kept between
+        calls, and after partial_fit they are only calculated again for the
+        features that occur in the classes of the new instances.
+        """
+        counts = self.count_feat_and_class
+        n_feat = counts.shape[1]
+        if (getattr(self, '_cooccurrence_sums', None) is None or
+                len(self._cooccurrence_sums) != n_feat):
+            self._cooccurrence_sums = np.zeros(n_feat)
+            self._presence = np.zeros(n_feat)
+            columns = slice(None)
+        else:
+            columns = np.flatnonzero(
+                counts[self._changed_classes].any(axis=0)
+            )
+
+        block = counts[:, columns]
+        classes, positions = np.nonzero(block)
+        present = block[classes, positions]
+        class_count = self.class_count_[classes]
+        terms = (xlogy(present, present) +
+                 xlogy(class_count - present, class_count - present) -
+                 xlogy(class_count, class_count))
+        self._cooccurrence_sums[columns] = np.bincount(
+            positions, weights=terms, minlength=block.shape[1]
+        )
+        self._presence[columns] = block.sum(axis=0)
+
+        presence = self._presence
+        class_count = self.class_count_
+        absence = class_count.sum() - presence
+        result = self._cooccurrence_sums - xlogy(presence, presence)
+        result -= xlogy(absence, self.instance_num - presence)
+        result += (xlogy(class_count, class_count).sum() -
+                   np.dot(class_count, self.class_log_prior_))
+        result /= self.instance_num
+        self.feat_information_gain = result
+
+    def log_prob_columns(self):
+        """Returns the feature log probabilities of each class and of all
+        the classes together, as the columns of a single matrix.
+
+        The last column is the log probability of each feature over all the
+        classes. The matrix is cached until the model changes.
+
+        Returns
+        -------
+        array-like, shape = [n_features, n_classes + 1]
+        """
+        cached_version, columns = getattr(self, '_columns_cache',
+                                          (None, None))
+        if cached_version != self.model_version:
+            columns = np.empty((self.feature_log_prob_.shape[1],
+                                self.feature_log_prob_.shape[0] + 1),
+                               dtype=self.feature_log_prob_.dtype)
+            columns[:, :-1] = self.feature_log_prob_.T
+            columns[:, -1] = logsumexp(self.feature_log_prob_.T +
+                                       self.class_log_prior_, axis=1)
+            self._columns_cache = (self.model_version, columns)
+        return columns
+
+    def _feature_marginal_log_prob(self):
+        """Returns the log probability of each feature over all the classes.
+
+        The value is cached until the model changes.
+
+        Returns
+        -------
+        array-like, shape = [n_features]
+        """
+        return self.log_prob_columns()[:, -1]
+
+    def joint_and_instance_log_proba(self, X):
+        """Calculates the joint log likelihood of each class and instance,
+        and the log probability of each instance, with a single product.
+
+        Parameters
+        ----------
+        X : {array-like, sparse matrix}, shape = [n_samples, n_features]
+
+        Returns
+        -------
+        jll : array-like, shape = [n_samples, n_classes]
+            log P(c) + log P(x|c) for each instance and class.
+
+        log_proba : array-like, shape = [n_samples]
+            The same value returned by instance_log_proba.
+        """
+        product = safe_sparse_dot(X, self.log_prob_columns())
+        return product[:, :-1] + self.class_log_prior_, product[:, -1]
+
+    def instance_log_proba(self, X):
+        """Calculates the log probability of each instance in X.
+
+        Unlike the probability, it does not underflow for long instances.
+
+        Parameters
+        ----------
+        X : {array-like, sparse matrix}, shape = [n_samples, n_features]
+
+        Returns
+        -------
+        array-like, shape = [n_samples]
         """
-        prob_Ik1_and_class = self.count_feat_and_class / self.instance_num
-        prob_Ik1 = self.count_feat_and_class.sum(axis=0) / self.instance_num
-        term1 = (prob_Ik1_and_class *
-                 ((np.log(prob_Ik1_and_class) - np.log(prob_Ik1)).T -
-                  self.class_log_prior_).T)
-        prob_Ik0_and_class = ((self.count_feat_and_class.T -
-                               self.class_count_).T * -1 / self.instance_num)
-        term2 = (prob_Ik0_and_class *
-                 ((np.log(prob_Ik0_and_class) - np.log(1 - prob_Ik1)).T -
-                  self.class_log_prior_).T)
-        self.feat_information_gain = (np.nan_to_num(term1).sum(axis=0) +
-                                      np.nan_to_num(term2).sum(axis=0))
+        return safe_sparse_dot(X, self._feature_marginal_log_prob())
 
     def instance_proba(self, X):
         """Calculates the probability of each instance in X.
@@ -74,7 +341,4 @@ class FeatMultinomialNB(MultinomialNB):
         -------
         array-like, shape = [n_samples]
         """
-        feat_prob = safe_sparse_dot(np.exp(self.class_log_prior_),
-                                    np.exp(self.feature_log_prob_)).T
-        instance_log_prob = safe_sparse_dot(X, np.log(feat_prob))
-        return np.exp(instance_log_prob)
+        return np.exp(self.instance_log_proba(X))
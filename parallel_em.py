@@ -0,0 +1,190 @@
+import ctypes
+import multiprocessing
+import numpy as np
+
+from multiprocessing.sharedctypes import RawArray
+from scipy.special import logsumexp
+from sklearn.utils.extmath import safe_sparse_dot
+
+
+class EMSums(object):
+    """The expected counts of the M-step of EM for the unlabeled instances.
+
+    Each instance adds its class probabilities, the expected number of times
+    it belongs to each class, to class_count, and their product with the
+    instance to feature_count. The counts are smoothed and normalized like
+    the ones of FeatMultinomialNB.fit to estimate the new parameters.
+    """
+    def __init__(self, n_class, n_feat, dtype=np.float64):
+        self.class_count = np.zeros(n_class, dtype=dtype)
+        self.feature_count = np.zeros((n_class, n_feat), dtype=dtype)
+
+    def add(self, class_proba, instances):
+        """Adds the counts of a chunk of instances.
+
+        Args:
+            class_proba: an array, shape = [n_instances, n_class]. The
+            probability of each class given each instance, multiplied by the
+            number of copies of the instance.
+            instances: the matrix of instances.
+        """
+        self.class_count += class_proba.sum(axis=0)
+        self.feature_count += safe_sparse_dot(class_proba.T, instances)
+
+    def merge(self, other):
+        """Adds the counts of other."""
+        self.class_count += other.class_count
+        self.feature_count += other.feature_count
+
+
+def add_unlabeled_chunk(sums, jll, instances, weights=None):
+    """Performs the E-step for a chunk of unlabeled instances.
+
+    The class probabilities of each instance are normalized in log space, so
+    they do not underflow even if the probabilities of all the instances do.
+
+    Args:
+        sums: an EMSums. The expected counts of the instances are added to
+        it.
+        jll: an array, shape = [n_instances, n_class]. The joint log
+        likelihood of each instance and class.
+        instances: the matrix of instances.
+        weights: Optional. An array with the number of copies of each
+        instance.
+
+    Returns:
+        The log likelihood of the instances.
+    """
+    instance_likelihood = logsumexp(jll, axis=1)
+    with np.errstate(invalid='ignore'):
+        predicted_proba = np.nan_to_num(np.exp(
+            jll - instance_likelihood[:, np.newaxis]
+        ))
+    if weights is not None:
+        predicted_proba *= weights[:, np.newaxis]
+        instance_likelihood = instance_likelihood * weights
+    sums.add(predicted_proba, instances)
+    return instance_likelihood.sum()
+
+
+def _shared_array(shape, dtype):
+    """Returns a numpy array in memory shared with the forked processes."""
+    dtype = np.dtype(dtype)
+    raw = RawArray(ctypes.c_char, int(np.prod(shape)) * dtype.itemsize)
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+
+# The state of the EMProcessPool, inherited by its processes when they are
+# forked.
+_state = None
+
+
+def _shard_statistics(shard):
+    """Adds the expected counts of a shard of the instances to the shared
+    sums.
+
+    Runs in the processes of the pool.
+
+    Returns:
+        The log likelihood of the instances of the shard.
+    """
+    start, end = _state['shards'][shard]
+    matrix = _state['matrix']
+    weights = _state['weights']
+    columns = _state['columns']
+    class_log_prior = _state['class_log_prior']
+    chunk_size = _state['chunk_size']
+    total = _state['total']
+    sums = EMSums(columns.shape[1] - 1, columns.shape[0], columns.dtype)
+    log_likelihood = 0.0
+    for chunk_start in range(start, end, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, end)
+        instances = matrix[chunk_start:chunk_end]
+        product = safe_sparse_dot(instances, columns)
+        log_likelihood += add_unlabeled_chunk(
+            sums, product[:, :-1] + class_log_prior, instances,
+            None if weights is None else weights[chunk_start:chunk_end]
+        )
+    with _state['lock']:
+        total.merge(sums)
+    return log_likelihood
+
+
+class EMProcessPool(object):
+    """Calculates the EM counts of the unlabeled instances in parallel.
+
+    The rows of the matrix are split in one shard of contiguous rows per
+    process, with approximately the same number of non zero elements. The
+    processes are forked when the pool is created, so they inherit the
+    matrix without copying or pickling it. The parameters of the classifier
+    and the counts of the M-step are exchanged through shared memory, and
+    each process adds its sums to the shared ones, so only the shard
+    numbers and the log likelihoods are pickled in each iteration.
+
+    This requires a platform where multiprocessing forks the processes.
+    """
+    def __init__(self, matrix, n_class, processes, weights=None,
+                 dtype=np.float64, chunk_size=10000):
+        """
+        Args:
+            matrix: a csr matrix with the unlabeled instances.
+            n_class: the number of classes of the classifier.
+            processes: the number of processes.
+            weights: Optional. An array with the number of copies of each
+            instance.
+            dtype: the type of the parameters and the counts.
+            chunk_size: the maximum number of instances classified at once.
+        """
+        global _state
+        n_feat = matrix.shape[1]
+        limits = np.searchsorted(
+            matrix.indptr, np.linspace(0, matrix.nnz, processes + 1)
+        )
+        limits[0], limits[-1] = 0, matrix.shape[0]
+        total = EMSums(n_class, n_feat, dtype)
+        total.class_count = _shared_array((n_class,), dtype)
+        total.feature_count = _shared_array((n_class, n_feat), dtype)
+        self._total = total
+        self._columns = _shared_array((n_feat, n_class + 1), dtype)
+        self._class_log_prior = _shared_array((n_class,), dtype)
+        self._n_shards = processes
+        _state = {
+            'matrix': matrix,
+            'weights': weights,
+            'shards': zip(limits[:-1], limits[1:]),
+            'columns': self._columns,
+            'class_log_prior': self._class_log_prior,
+            'chunk_size': chunk_size,
+            'total': total,
+            'lock': multiprocessing.Lock(),
+        }
+        self._pool = multiprocessing.Pool(processes)
+
+    def add_statistics(self, sums, columns, class_log_prior):
+        """Adds the expected counts of all the instances to sums.
+
+        Args:
+            sums: an EMSums.
+            columns: the log probability of each feature given each class,
+            and the marginal log probability of the feature in the last
+            column, like FeatMultinomialNB.log_prob_columns.
+            class_log_prior: the log probability of each class.
+
+        Returns:
+            The log likelihood of the instances.
+        """
+        self._columns[:] = columns
+        self._class_log_prior[:] = class_log_prior
+        self._total.class_count[:] = 0
+        self._total.feature_count[:] = 0
+        log_likelihood = sum(self._pool.map(_shard_statistics,
+                                            range(self._n_shards)))
+        sums.merge(self._total)
+        return log_likelihood
+
+    def close(self):
+        """Stops the processes of the pool."""
+        global _state
+        self._pool.close()
+        self._pool.join()
+        _state = None
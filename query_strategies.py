@@ -0,0 +1,143 @@
+"""Strategies to select the unlabeled instances asked to the user.
+
+A strategy is a function that receives the pipe, a Corpus with the
+unlabeled instances and the posterior probability of each class for each
+instance (shape = [n_instances, n_class]), and returns a numpy array with a
+score for each instance. The instance with the lowest score is asked first.
+The strategies are registered by name in STRATEGIES, and the pipe uses the
+one named by its query_strategy configuration.
+"""
+import numpy as np
+
+from scipy.special import logsumexp, xlogy
+from scipy.sparse import vstack
+from sklearn.base import clone
+from sklearn.utils.extmath import safe_sparse_dot
+
+
+STRATEGIES = {}
+
+
+def register_strategy(name):
+    """Decorator that adds a strategy to STRATEGIES with the given name."""
+    def register(strategy):
+        STRATEGIES[name] = strategy
+        return strategy
+    return register
+
+
+@register_strategy('entropy')
+def entropy(pipe, corpus, posterior):
+    """The entropy of the posterior of each instance, with the sign changed,
+    so the instances where the classifier is less certain are asked first.
+    """
+    return xlogy(posterior, posterior).sum(axis=1)
+
+
+@register_strategy('least_confidence')
+def least_confidence(pipe, corpus, posterior):
+    """The probability of the most probable class, so the instances where
+    the classifier is less confident are asked first."""
+    return posterior.max(axis=1)
+
+
+@register_strategy('margin')
+def margin(pipe, corpus, posterior):
+    """The difference between the probabilities of the two most probable
+    classes."""
+    if posterior.shape[1] < 2:
+        return posterior.max(axis=1)
+    best = np.partition(posterior, posterior.shape[1] - 2, axis=1)
+    return best[:, -1] - best[:, -2]
+
+
+def _labeled_instances(pipe):
+    """Returns the matrix and the targets of the training and user corpus.
+    """
+    if len(pipe.user_corpus):
+        return (vstack((pipe.training_corpus.instances,
+                        pipe.user_corpus.instances), format='csr'),
+                (pipe.training_corpus.primary_targets +
+                 pipe.user_corpus.primary_targets))
+    return (pipe.training_corpus.instances,
+            pipe.training_corpus.primary_targets)
+
+
+@register_strategy('vote_entropy')
+def vote_entropy(pipe, corpus, posterior):
+    """The entropy of the votes of a committee, with the sign changed.
+
+    The committee has committee_size copies of the classifier, each one
+    fitted with a bootstrap sample of the labeled instances. The samples
+    are given as the number of copies of each instance in sample_weight, so
+    the matrix is never copied. The instances where the committee disagrees
+    most are asked first.
+    """
+    instances, targets = _labeled_instances(pipe)
+    random = np.random.RandomState(0)
+    n_members = pipe.committee_size
+    votes = np.zeros((len(corpus), posterior.shape[1]))
+    for _ in range(n_members):
+        weights = np.bincount(
+            random.randint(len(targets), size=len(targets)),
+            minlength=len(targets)
+        ).astype(np.float64)
+        member = clone(pipe.classifier).fit(instances, targets,
+                                            sample_weight=weights)
+        for start, chunk in corpus.iter_chunks(pipe.chunk_size):
+            predicted = member.predict_log_proba(chunk).argmax(axis=1)
+            votes[np.arange(start, start + chunk.shape[0]), predicted] += 1
+    votes /= n_members
+    return xlogy(votes, votes).sum(axis=1)
+
+
+@register_strategy('expected_error_reduction')
+def expected_error_reduction(pipe, corpus, posterior):
+    """The expected error of the classifier after labeling each instance.
+
+    Only eer_subsample random instances of the corpus are candidates, and
+    the error is measured over the same instances, as the sum of one minus
+    the probability of the predicted class. The rest of the instances have
+    an infinite score. The classifier after labeling an instance is
+    approximated adding the instance to the counts of a MultinomialNB, so
+    every candidate and class is evaluated with sparse products instead of
+    fitting the classifier again.
+    """
+    classifier = pipe.classifier
+    n_class = posterior.shape[1]
+    n_sample = min(pipe.eer_subsample, len(corpus))
+    sample = np.sort(np.random.RandomState(0).choice(len(corpus), n_sample,
+                                                     replace=False))
+    instances = corpus.instances[sample].tocsr()
+    smoothed = classifier.feature_count_ + classifier.alpha
+    totals = smoothed.sum(axis=1)
+    jll = safe_sparse_dot(instances, np.log(smoothed).T)
+    jll -= instances.sum(axis=1).A * np.log(totals)
+    class_count = classifier.class_count_
+    log_total = np.log(class_count.sum() + 1)
+    lengths = np.asarray(instances.sum(axis=1)).ravel()
+    rows = np.repeat(np.arange(n_sample), np.diff(instances.indptr))
+
+    errors = np.empty((n_sample, n_class))
+    for class_number in range(n_class):
+        # change[u, j]: change of the log likelihood of the instance u for
+        # the class after adding the instance j to it
+        added = instances.copy()
+        added.data = np.log1p(
+            instances.data / smoothed[class_number, instances.indices]
+        )
+        change = safe_sparse_dot(instances, added.T, dense_output=True)
+        change = np.asarray(change) - np.outer(
+            lengths, np.log1p(lengths / totals[class_number])
+        )
+        prior = np.log(class_count) - log_total
+        prior[class_number] = np.log(class_count[class_number] + 1) - \
+            log_total
+        new_jll = np.repeat((jll + prior)[:, np.newaxis, :], n_sample,
+                            axis=1)
+        new_jll[:, :, class_number] += change
+        best = new_jll.max(axis=2) - logsumexp(new_jll, axis=2)
+        errors[:, class_number] = (1 - np.exp(best)).sum(axis=0)
+    result = np.full(len(corpus), np.inf)
+    result[sample] = (errors * posterior[sample]).sum(axis=1)
+    return result
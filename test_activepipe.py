@@ -3,8 +3,10 @@ import unittest
 import numpy as np
 import mock
 
+import activepipe
 from activepipe import ActivePipeline
 from corpus import Corpus
+from featmultinomial import FeatMultinomialNB
 from featureforge.vectorizer import Vectorizer
 from scipy.sparse import csr_matrix
 from sklearn.preprocessing import normalize
@@ -59,88 +61,179 @@ class TestActivePipe(unittest.TestCase):
         )
         self.instance_prob = np.array([0.02, 0.09, 0.01, 0.12, 0.08])
 
+    def _log_proba(self, shift=0):
+        """Returns a fake joint_and_instance_log_proba for the EM tests.
+
+        The class probabilities are instance_class_prob and the instance
+        probabilities are instance_prob, both multiplied by exp(shift).
+        """
+        def log_proba(classifier, instances):
+            n_instances = instances.shape[0]
+            return (np.log(self.instance_class_prob[:n_instances]) + shift,
+                    np.log(self.instance_prob[:n_instances]) + shift)
+        return log_proba
+
     def test_em_feat_class_no_labeled(self):
         """Tests if the feature_log_prob matrix is calculated correctly.
-        P(fj|ck) = sum_i(P(xi) * fj(xi) * P(ck|xi))
-        P(f0|c0) = 0.5*0.02*1 + 0.25*0.09*1 + 0.7*0*0.01 + 0.1*1*0.12 + 0.8*2*0.08 = 0.1725
-        P(f0|c1) = 0.5*0.02*1 + 0.75*0.09*1 + 0.3*0*0.01 + 0.9*1*0.12 + 0.2*2*0.08 = 0.2175
-        P(f1|c0) = 0.5*0.02*1 + 0.25*0.09*1 + 0.7*0*0.01 + 0.1*0*0.12 + 0.8*2*0.08 = 0.1605
-        P(f1|c1) = 0.5*0.02*1 + 0.75*0.09*1 + 0.3*0*0.01 + 0.9*0*0.12 + 0.2*2*0.08 = 0.1095
-        P(f2|c0) = 0.5*0.02*1 + 0.25*0.09*2 + 0.7*1*0.01 + 0.1*0*0.12 + 0.8*2*0.08 = 0.19
-        P(f2|c1) = 0.5*0.02*1 + 0.75*0.09*2 + 0.3*1*0.01 + 0.9*0*0.12 + 0.2*2*0.08 = 0.18
+        P(fj|ck) = (sum_i(fj(xi) * P(ck|xi)) + alpha) / normalization
+        n(f0|c0) = 0.5*1 + 0.25*1 + 0.7*0 + 0.1*1 + 0.8*2 = 2.45
+        n(f0|c1) = 0.5*1 + 0.75*1 + 0.3*0 + 0.9*1 + 0.2*2 = 2.55
+        n(f1|c0) = 0.5*1 + 0.25*1 + 0.7*0 + 0.1*0 + 0.8*2 = 2.35
+        n(f1|c1) = 0.5*1 + 0.75*1 + 0.3*0 + 0.9*0 + 0.2*2 = 1.65
+        n(f2|c0) = 0.5*1 + 0.25*2 + 0.7*1 + 0.1*0 + 0.8*2 = 3.3
+        n(f2|c1) = 0.5*1 + 0.75*2 + 0.3*1 + 0.9*0 + 0.2*2 = 2.7
         """
-        expected = np.array([[0.32982792, 0.30688337, 0.36328872],
-                             [0.42899408, 0.21597633, 0.35502959]])
-        with mock.patch('featmultinomial.FeatMultinomialNB.predict_proba',
-                        return_value=self.instance_class_prob) as mock_pred:
-            with mock.patch('featmultinomial.FeatMultinomialNB.instance_proba',
-                            return_value=self.instance_prob) as mock_inst_p:
-                self.pipe.training_corpus = Corpus()
-                self.pipe._expectation_maximization()
-                np.testing.assert_array_almost_equal(
-                    self.pipe.classifier.feature_log_prob_,
-                    np.log(expected)
-                )
+        expected = np.array([[3.45, 3.35, 4.3], [3.55, 2.65, 3.7]])
+        expected /= expected.sum(axis=1)[:, np.newaxis]
+        with mock.patch('featmultinomial.FeatMultinomialNB.'
+                        'joint_and_instance_log_proba',
+                        new=self._log_proba()):
+            self.pipe.training_corpus = Corpus()
+            self.pipe._expectation_maximization()
+            np.testing.assert_array_almost_equal(
+                self.pipe.classifier.feature_log_prob_,
+                np.log(expected)
+            )
 
     def test_em_class_no_labeled(self):
         """Tests if the class_log_prior_ matrix is calculated correctly.
-        P(ck) = sum_i(P(xi) * P(ck|xi))
-        P(c0) = 0.5*0.02 + 0.25*0.09 + 0.7*0.01 + 0.1*0.12 + 0.8*0.08 = 0.1155
-        P(c1) = 0.5*0.02 + 0.75*0.09 + 0.3*0.01 + 0.9*0.12 + 0.2*0.08 = 0.2045
+        P(ck) = sum_i(P(ck|xi)) / number of instances
+        P(c0) = (0.5 + 0.25 + 0.7 + 0.1 + 0.8) / 5 = 0.47
+        P(c1) = (0.5 + 0.75 + 0.3 + 0.9 + 0.2) / 5 = 0.53
         """
-        expected = np.array([0.3609375, 0.6390625])
-
-        with mock.patch('featmultinomial.FeatMultinomialNB.predict_proba',
-                        return_value=self.instance_class_prob) as mock_pred:
-            with mock.patch('featmultinomial.FeatMultinomialNB.instance_proba',
-                            return_value=self.instance_prob) as mock_inst_p:
-                self.pipe.training_corpus = Corpus()
-                self.pipe._expectation_maximization()
-                np.testing.assert_array_almost_equal(
-                    self.pipe.classifier.class_log_prior_,
-                    np.log(expected)
-                )
+        expected = np.array([0.47, 0.53])
+
+        with mock.patch('featmultinomial.FeatMultinomialNB.'
+                        'joint_and_instance_log_proba',
+                        new=self._log_proba()):
+            self.pipe.training_corpus = Corpus()
+            self.pipe._expectation_maximization()
+            np.testing.assert_array_almost_equal(
+                self.pipe.classifier.class_log_prior_,
+                np.log(expected)
+            )
 
     def test_em_feat_class(self):
         """
-        P(fj|ck) = Pu(fj|ck) * 0.1 + 0.9* sum_i(P(xl_i) * fj(xl_i) * {0,1})
-        P(f0|c0) = 0.1 * 0.1725 + 0.9 * (0.02*0*0 + 0.09*1*1 + 0.01*0*1) = 0.09825
-        P(f0|c1) = 0.1 * 0.2175 + 0.9 * (0.02*0*1 + 0.09*1*0 + 0.01*0*0) = 0.02175
-        P(f1|c0) = 0.1 * 0.1605 + 0.9 * (0.02*1*0 + 0.09*1*1 + 0.01*1*1) = 0.10605
-        P(f1|c1) = 0.1 * 0.1095 + 0.9 * (0.02*1*1 + 0.09*1*0 + 0.01*1*0) = 0.02895
-        P(f2|c0) = 0.1 * 0.19 + 0.9 * (0.02*0*0 + 0.09*1*1 + 0.01*1*1) = 0.109
-        P(f2|c1) = 0.1 * 0.18 + 0.9 * (0.02*0*1 + 0.09*1*0 + 0.01*1*0) = 0.018
+        n(fj|ck) = 0.1 * nu(fj|ck) + 0.9 * sum_i(fj(xl_i) * {0,1})
+        n(f0|c0) = 0.1 * 2.45 + 0.9 * (0*0 + 1*1 + 0*1) = 1.145
+        n(f0|c1) = 0.1 * 2.55 + 0.9 * (0*1 + 1*0 + 0*0) = 0.255
+        n(f1|c0) = 0.1 * 2.35 + 0.9 * (1*0 + 1*1 + 1*1) = 2.035
+        n(f1|c1) = 0.1 * 1.65 + 0.9 * (1*1 + 1*0 + 1*0) = 1.065
+        n(f2|c0) = 0.1 * 3.3 + 0.9 * (0*0 + 1*1 + 1*1) = 2.13
+        n(f2|c1) = 0.1 * 2.7 + 0.9 * (0*1 + 1*0 + 1*0) = 0.27
+        P(fj|ck) = (n(fj|ck) + alpha) / normalization
         """
-        expected = np.array([[0.31359719, 0.3384934, 0.34790935],
-                             [0.31659388, 0.421397379, 0.262008733]])
-        instance_prob_fun = lambda s, x: self.instance_prob[:x.shape[0]]
-        with mock.patch('featmultinomial.FeatMultinomialNB.predict_proba',
-                        return_value=self.instance_class_prob) as mock_pred:
-            with mock.patch('featmultinomial.FeatMultinomialNB.instance_proba',
-                            new=instance_prob_fun) as mock_inst_p:
-                self.pipe._expectation_maximization()
-                np.testing.assert_array_almost_equal(
-                    self.pipe.classifier.feature_log_prob_,
-                    np.log(expected)
-                )
+        expected = np.array([[2.145, 3.035, 3.13], [1.255, 2.065, 1.27]])
+        expected /= expected.sum(axis=1)[:, np.newaxis]
+        with mock.patch('featmultinomial.FeatMultinomialNB.'
+                        'joint_and_instance_log_proba',
+                        new=self._log_proba()):
+            self.pipe._expectation_maximization()
+            np.testing.assert_array_almost_equal(
+                self.pipe.classifier.feature_log_prob_,
+                np.log(expected)
+            )
 
     def test_em_class(self):
         """Tests if the class_log_prior_ matrix is calculated correctly.
-        P(ck) = sum_i(P(xui) * P(ck|xui)) * 0.1 + sum_i(P(xli) * P(ck|xli)) * 0.9
-        P(c0) = 0.1155 * 0.1 + 0.9 * (0*0.02 + 1*0.09 + 1*0.01) = 0.10155
-        P(c1) = 0.2045 * 0.1 + 0.9 * (1*0.02 + 0*0.09 + 0*0.01) = 0.03845
+        n(ck) = sum_i(P(ck|xui)) * 0.1 + sum_i({0,1}) * 0.9
+        n(c0) = 2.35 * 0.1 + 0.9 * (0 + 1 + 1) = 2.035
+        n(c1) = 2.65 * 0.1 + 0.9 * (1 + 0 + 0) = 1.165
         """
-        expected = np.array([0.725357142, 0.27464285714])
-        instance_prob_fun = lambda s, x: self.instance_prob[:x.shape[0]]
-        with mock.patch('featmultinomial.FeatMultinomialNB.predict_proba',
-                        return_value=self.instance_class_prob) as mock_pred:
-            with mock.patch('featmultinomial.FeatMultinomialNB.instance_proba',
-                            new=instance_prob_fun) as mock_inst_p:
-                self.pipe._expectation_maximization()
-                np.testing.assert_array_almost_equal(
-                    self.pipe.classifier.class_log_prior_,
-                    np.log(expected)
-                )
+        expected = np.array([2.035, 1.165]) / 3.2
+        with mock.patch('featmultinomial.FeatMultinomialNB.'
+                        'joint_and_instance_log_proba',
+                        new=self._log_proba()):
+            self.pipe._expectation_maximization()
+            np.testing.assert_array_almost_equal(
+                self.pipe.classifier.class_log_prior_,
+                np.log(expected)
+            )
+
+    def test_em_underflow(self):
+        """The result must not change if the instances are very unlikely.
+        """
+        expected = np.array([2.035, 1.165]) / 3.2
+        with mock.patch('featmultinomial.FeatMultinomialNB.'
+                        'joint_and_instance_log_proba',
+                        new=self._log_proba(-2000)):
+            self.pipe._expectation_maximization()
+            np.testing.assert_array_almost_equal(
+                self.pipe.classifier.class_log_prior_,
+                np.log(expected)
+            )
+
+    def test_em_iterations(self):
+        """The likelihood must never decrease, and EM must stop when it
+        converges."""
+        for training_corpus in (self.pipe.training_corpus, Corpus()):
+            self.pipe._train()
+            self.pipe.training_corpus = training_corpus
+            self.pipe.em_max_iterations = 30
+            report = self.pipe._expectation_maximization()
+            self.assertIs(self.pipe.em_report, report)
+            self.assertLess(len(report), self.pipe.em_max_iterations)
+            log_likelihoods = [step['log_likelihood'] for step in report]
+            self.assertTrue(np.all(np.isfinite(log_likelihoods)))
+            self.assertTrue(np.all(np.diff(log_likelihoods) >= -1e-10))
+
+        self.pipe.em_max_iterations = 1
+        report = self.pipe._expectation_maximization()
+        self.assertEqual(len(report), 1)
+        self.assertTrue(np.isfinite(report[0]['log_likelihood']))
+        self.assertGreaterEqual(report[0]['seconds'], 0)
+
+    def test_em_processes(self):
+        """The statistics calculated in several processes must be equal."""
+        class_log_prior = self.pipe.classifier.class_log_prior_.copy()
+        feature_log_prob = self.pipe.classifier.feature_log_prob_.copy()
+        expected = self.pipe._expectation_maximization()
+        expected_prior = self.pipe.classifier.class_log_prior_
+        expected_prob = self.pipe.classifier.feature_log_prob_
+        self.pipe.classifier.class_log_prior_ = class_log_prior
+        self.pipe.classifier.feature_log_prob_ = feature_log_prob
+        self.pipe.em_processes = 2
+        self.pipe.chunk_size = 2
+        report = self.pipe._expectation_maximization()
+        self.assertEqual(len(report), len(expected))
+        self.assertAlmostEqual(report[-1]['log_likelihood'],
+                               expected[-1]['log_likelihood'])
+        np.testing.assert_array_almost_equal(
+            self.pipe.classifier.class_log_prior_, expected_prior
+        )
+        np.testing.assert_array_almost_equal(
+            self.pipe.classifier.feature_log_prob_, expected_prob
+        )
+
+    def test_labeled_rows_cache(self):
+        """The labeled rows must be built again only when the training
+        corpus changes."""
+        rows = self.pipe._labeled_rows()
+        # The labeled instances are not read again in each iteration
+        with mock.patch.object(self.pipe.training_corpus, 'iter_chunks') as \
+                iter_chunks:
+            self.pipe._expectation_maximization()
+            self.assertFalse(iter_chunks.called)
+        self.assertIs(self.pipe._labeled_rows(), rows)
+        (training_corpus, _, positions, instance_class_matrix, class_count,
+         feature_count) = rows
+        np.testing.assert_array_equal(
+            instance_class_matrix.toarray().argmax(axis=1), positions
+        )
+        np.testing.assert_array_equal(class_count, [2, 1])
+        np.testing.assert_array_equal(
+            feature_count,
+            instance_class_matrix.T * training_corpus.instances.toarray()
+        )
+        self.assertEqual(
+            [self.pipe.classes[position] for position in positions],
+            training_corpus.primary_targets
+        )
+        instance, targets, _ = self.pipe.training_corpus.get_instance(0)
+        self.pipe.training_corpus.add_instance(instance, targets)
+        self.assertEqual(len(self.pipe._labeled_rows()[2]),
+                         len(self.pipe.training_corpus))
 
     def test_em_sum_to_one(self):
         """Checks that both parameters estimated by the em step sums one."""
@@ -153,6 +246,116 @@ class TestActivePipe(unittest.TestCase):
             np.ones(2)
         )
 
+    def test_em_chunks(self):
+        """The result of EM must not depend on the size of the chunks."""
+        class_log_prior = self.pipe.classifier.class_log_prior_.copy()
+        feature_log_prob = self.pipe.classifier.feature_log_prob_.copy()
+        self.pipe._expectation_maximization()
+        expected_prior = self.pipe.classifier.class_log_prior_
+        expected_prob = self.pipe.classifier.feature_log_prob_
+        self.pipe.classifier.class_log_prior_ = class_log_prior
+        self.pipe.classifier.feature_log_prob_ = feature_log_prob
+        self.pipe.chunk_size = 2
+        self.pipe._expectation_maximization()
+        np.testing.assert_array_almost_equal(
+            self.pipe.classifier.class_log_prior_, expected_prior
+        )
+        np.testing.assert_array_almost_equal(
+            self.pipe.classifier.feature_log_prob_, expected_prob
+        )
+
+    def test_deduplicate(self):
+        """Collapsing the identical instances must not change the model."""
+        for corpus in (self.pipe.training_corpus, self.pipe.unlabeled_corpus):
+            instance, targets, _ = corpus.get_instance(0)
+            corpus.add_instance(instance, targets)
+        results = []
+        for deduplicate in (False, True):
+            self.pipe.deduplicate = deduplicate
+            self.pipe._train()
+            self.pipe._expectation_maximization()
+            self.pipe.get_next_instance()
+            results.append((
+                self.pipe.classifier.class_log_prior_.copy(),
+                self.pipe.classifier.feature_log_prob_.copy(),
+                self.pipe.classifier.feat_information_gain.copy(),
+                self.pipe.unlabeled_corpus.extra_info['entropy'].copy()
+            ))
+        for expected, result in zip(*results):
+            np.testing.assert_array_almost_equal(result, expected)
+
+    def test_incremental_training(self):
+        """Adding the new user instances must be equal to fitting again."""
+        self.pipe._train()
+        instance, _, _ = self.pipe.unlabeled_corpus.get_instance(0)
+        self.pipe.user_corpus.add_instance(instance, [self.pipe.classes[0]])
+        self.pipe.handle_feature_prediction(0, [1, 2], [1])
+        incremental = self.pipe.classifier
+        with mock.patch.object(incremental, 'fit') as fit:
+            self.pipe._train()
+            self.assertFalse(fit.called)
+        self.pipe.classifier = FeatMultinomialNB()
+        self.pipe._train()
+        for attribute in ['feature_count_', 'class_count_',
+                          'count_feat_and_class', 'feature_log_prob_',
+                          'class_log_prior_', 'feat_information_gain']:
+            np.testing.assert_array_almost_equal(
+                getattr(incremental, attribute),
+                getattr(self.pipe.classifier, attribute)
+            )
+
+    def test_fit_error(self):
+        """The errors of the classifier must be raised to the caller."""
+        self.pipe.incremental_training = False
+        with mock.patch.object(self.pipe.classifier, 'fit',
+                               side_effect=ValueError):
+            self.assertRaises(ValueError, self.pipe._train)
+
+    def test_dtype(self):
+        """A float32 pipe must select the same instances."""
+        pipe = ActivePipeline(dtype=np.float32, **testing_config)
+        self.assertEqual(pipe.classifier.feature_log_prob_.dtype, np.float32)
+        self.assertEqual(pipe.user_features.dtype, np.float32)
+        self.assertEqual(pipe.asked_features.dtype, bool)
+        pipe._expectation_maximization()
+        self.pipe._expectation_maximization()
+        self.assertEqual(pipe.classifier.feature_log_prob_.dtype, np.float32)
+        np.testing.assert_array_almost_equal(
+            pipe.classifier.feature_log_prob_,
+            self.pipe.classifier.feature_log_prob_, decimal=5
+        )
+        self.assertEqual(pipe.get_next_instance(),
+                         self.pipe.get_next_instance())
+
+    def test_evaluate_corpus(self):
+        """The chunked evaluation must match the sklearn metrics."""
+        from sklearn.metrics import confusion_matrix
+        self.pipe.chunk_size = 1
+        score, matrix = self.pipe._evaluate_corpus(self.pipe.test_corpus)
+        predicted = self.pipe.predict(self.pipe.test_corpus.instances)
+        self.assertAlmostEqual(score, self.pipe.classifier.score(
+            self.pipe.test_corpus.instances,
+            self.pipe.test_corpus.primary_targets
+        ))
+        np.testing.assert_array_equal(matrix, confusion_matrix(
+            self.pipe.test_corpus.primary_targets, predicted
+        ))
+
+    def test_evaluation_cache(self):
+        """The test corpus must be classified once per model version."""
+        classifier = self.pipe.classifier
+        with mock.patch.object(classifier, 'predict_log_proba',
+                               wraps=classifier.predict_log_proba) as predict:
+            self.pipe._train()
+            self.assertEqual(predict.call_count, 2)
+            report = self.pipe.get_report()
+            self.pipe.evaluate_test()
+            self.assertEqual(predict.call_count, 2)
+            self.pipe.handle_feature_prediction(0, [1, 2], [1])
+            self.pipe.evaluate_test()
+            self.assertEqual(predict.call_count, 3)
+        self.assertIn(str(self.pipe.classes[0]), report)
+
     def test_get_instance_corpus(self):
         """Test the three instance corpus loaded from files."""
         self.assertEqual(len(self.pipe.training_corpus), len(X))
@@ -160,6 +363,35 @@ class TestActivePipe(unittest.TestCase):
         self.assertEqual(len(self.pipe.unlabeled_corpus), len(U_vectors))
         self.assertEqual(len(self.pipe.user_corpus), 0)
 
+    def test_defer_training(self):
+        """The classifier must be trained when it is first needed, and the
+        test corpus must not be read before the first question."""
+        with mock.patch('activepipe._load_corpus',
+                        wraps=activepipe._load_corpus) as load_corpus:
+            pipe = ActivePipeline(defer_training=True, **testing_config)
+            self.assertFalse(load_corpus.called)
+            self.assertIsNone(pipe.user_features)
+            self.assertEqual(pipe.get_class_options(), [0, 1])
+            self.assertIsNotNone(pipe.get_next_instance())
+            self.assertEqual(pipe.user_features.shape, (2, 3))
+            self.assertEqual(
+                sorted(call[0][0] for call in load_corpus.call_args_list),
+                sorted([testing_config['training_corpus_f'],
+                        testing_config['u_corpus_f']])
+            )
+            # The classifier of the first training is evaluated when the
+            # precision is read
+            pipe.handle_feature_prediction(0, [1, 2], [1])
+            self.assertEqual(len(pipe.recorded_precision), 1)
+            self.assertEqual(load_corpus.call_count, 3)
+        expected = ActivePipeline(**testing_config).recorded_precision[0]
+        record = pipe.recorded_precision[0]
+        self.assertEqual(sorted(record), sorted(expected))
+        self.assertEqual(record['testing_precision'],
+                         expected['testing_precision'])
+        np.testing.assert_array_equal(record['confusion_matrix'],
+                                      expected['confusion_matrix'])
+
     def test_get_feature_corpus(self):
         """Test the feature corpus loaded from file."""
         self.assertEqual(self.pipe.feature_corpus.shape, (2, 3))
@@ -206,6 +438,40 @@ class TestActivePipe(unittest.TestCase):
         feat_indexes = self.pipe.get_next_features(class_number=0)
         self.assertEqual(feat_indexes, [1])
 
+    def test_get_next_features_top(self):
+        """The features must be the ones with the highest counts that were
+        not asked, sorted by IG."""
+        random = np.random.RandomState(0)
+        self.pipe.classifier.feature_count_ = random.rand(2, 50)
+        self.pipe.classifier.feat_information_gain = random.rand(50)
+        self.pipe.asked_features = random.rand(2, 50) < 0.3
+        self.pipe.number_of_features = 5
+        for _ in range(4):
+            available = np.flatnonzero(~self.pipe.asked_features[1])
+            counts = self.pipe.classifier.feature_count_[1]
+            expected = available[np.argsort(-counts[available])][:5]
+            expected = sorted(
+                expected,
+                key=lambda i: -self.pipe.classifier.feat_information_gain[i]
+            )
+            result = self.pipe.get_next_features(1)
+            self.assertEqual(result, expected)
+            self.pipe.asked_features[1][result[:3]] = True
+
+    def test_get_next_features_cache(self):
+        """Labeling features must not select the candidates again."""
+        self.pipe.number_of_features = 1
+        feature = self.pipe.get_next_features(0)[0]
+        key = self.pipe._candidate_cache[0][0]
+        self.pipe.handle_feature_prediction(0, [feature], [feature])
+        self.assertNotIn(feature, self.pipe.get_next_features(0))
+        self.assertEqual(self.pipe._candidate_cache[0][0], key)
+        instance, _, _ = self.pipe.unlabeled_corpus.get_instance(0)
+        self.pipe.user_corpus.add_instance(instance, [self.pipe.classes[0]])
+        self.pipe._train()
+        self.pipe.get_next_features(0)
+        self.assertNotEqual(self.pipe._candidate_cache[0][0], key)
+
     def test_handle_feature_prediction(self):
         """Positive and negative examples must be added to aked_features.
 
@@ -215,17 +481,20 @@ class TestActivePipe(unittest.TestCase):
         self.pipe.handle_feature_prediction(class_number, full_set=[0, 1, 2],
                                             prediction=[1])
         self.assertEqual(self.pipe.user_features[0][1],
-                         self.pipe.classifier.alpha + self.pipe.feature_boost,
+                         self.pipe.alpha + self.pipe.feature_boost,
                          msg='Bad Positive Example')
         self.assertEqual(self.pipe.user_features[0][0],
-                         self.pipe.classifier.alpha,
+                         self.pipe.alpha,
                          msg='Change in non labeled feature')
         self.assertTrue(np.all(self.pipe.user_features[1] ==
-                               self.pipe.classifier.alpha),
+                               self.pipe.alpha),
                         msg='Change in non labeled feature')
         self.assertTrue(self.pipe.asked_features[class_number][0])
         self.assertTrue(self.pipe.asked_features[class_number][1])
         self.assertTrue(self.pipe.asked_features[class_number][2])
+        # The classifier uses the new features without training again
+        np.testing.assert_array_equal(self.pipe.classifier.alpha[0],
+                                      self.pipe.user_features[0])
 
     def test_get_next_instance(self):
         """Checks next instance selection using entropy.
@@ -241,11 +510,103 @@ class TestActivePipe(unittest.TestCase):
             while len(self.pipe.unlabeled_corpus) != 0:
                 indexes.append(self.pipe.get_next_instance())
                 self.pipe.unlabeled_corpus.pop_instance(indexes[-1])
-            rigth_order = [3, 3, 1, 1, 0]
+            # The row ids do not change when other instances are popped.
+            rigth_order = [0, 2, 1, 4, 3]
             self.assertEqual(indexes, rigth_order)
 
             self.assertIsNone(self.pipe.get_next_instance())
 
+    def test_get_next_instances(self):
+        """The batch must start with the best instance and then add the
+        candidates less similar to the batch."""
+        with mock.patch('featmultinomial.FeatMultinomialNB.predict_proba',
+                        return_value=self.instance_class_prob):
+            self.assertEqual(self.pipe.get_next_instances(1), [0])
+            self.assertEqual(self.pipe.get_next_instances(3), [0, 2, 3])
+            self.pipe.batch_candidates = 1
+            self.assertEqual(self.pipe.get_next_instances(2), [0, 2])
+            self.pipe.unlabeled_corpus.pop_instance(0)
+            self.assertEqual(self.pipe.get_next_instances(10), [2, 1, 4, 3])
+
+    def test_patch_posterior(self):
+        """The probabilities updated after labeling features must be equal
+        to classifying the unlabeled corpus again."""
+        for deduplicate in (False, True):
+            self.pipe.deduplicate = deduplicate
+            self.pipe.get_next_instance()
+            if not deduplicate:
+                self.pipe.unlabeled_corpus.pop_instance(1)
+            self.pipe.handle_feature_prediction(0, [0, 1], [1])
+            self.pipe.handle_feature_prediction(1, [2], [2])
+            classifier = self.pipe.classifier
+            with mock.patch.object(
+                    classifier, 'predict_proba',
+                    wraps=classifier.predict_proba) as predict_proba:
+                corpus, posterior, _ = self.pipe._unlabeled_posterior()
+                self.assertFalse(predict_proba.called)
+            np.testing.assert_array_almost_equal(
+                posterior, classifier.predict_proba(corpus.instances)
+            )
+
+    def test_get_next_instance_does_not_compact(self):
+        """Selecting and popping instances between trainings must not
+        compact the unlabeled corpus."""
+        corpus = self.pipe.unlabeled_corpus
+        corpus.compaction_ratio = 1
+        self.pipe.get_next_instance()
+        with mock.patch.object(corpus, 'compact',
+                               wraps=corpus.compact) as compact:
+            for _ in range(4):
+                corpus.pop_instance(self.pipe.get_next_instance())
+            self.assertFalse(compact.called)
+
+    def test_patch_posterior_after_train(self):
+        """Training after labeling features must not classify the
+        unlabeled corpus or the test corpus again."""
+        self.pipe.get_next_instance()
+        self.pipe.handle_feature_prediction(0, [0, 1], [1])
+        classifier = self.pipe.classifier
+        with mock.patch.object(classifier, 'predict_proba',
+                               wraps=classifier.predict_proba) as proba, \
+                mock.patch.object(classifier, 'predict_log_proba',
+                                  wraps=classifier.predict_log_proba) as log:
+            self.pipe._train()
+            self.pipe.get_next_instance()
+            self.assertFalse(proba.called)
+            # The test and training corpus, once each
+            self.assertEqual(log.call_count, 2)
+            self.pipe._train()
+            self.assertEqual(log.call_count, 2)
+        corpus, posterior, _ = self.pipe._unlabeled_posterior()
+        np.testing.assert_array_almost_equal(
+            posterior, classifier.predict_proba(corpus.instances)
+        )
+
+    def test_most_probable_classes(self):
+        """The classes must be sorted by probability and cached until the
+        classifier changes."""
+        rows = self.pipe.unlabeled_corpus.row_ids[:3].tolist()
+        classifier = self.pipe.classifier
+        with mock.patch.object(classifier, 'predict_log_proba',
+                               wraps=classifier.predict_log_proba) as predict:
+            result = self.pipe.most_probable_classes(rows, k=2)
+            self.assertEqual(self.pipe.most_probable_classes(rows[1:], k=2),
+                             result[1:])
+            self.assertEqual(predict.call_count, 1)
+            self.pipe.handle_feature_prediction(0, [1, 2], [1])
+            self.pipe.most_probable_classes(rows, k=2)
+            self.assertEqual(predict.call_count, 2)
+        log_proba = classifier.predict_log_proba(
+            self.pipe.unlabeled_corpus.get_instances(rows[:1])
+        )[0]
+        expected = classifier.classes_[np.argsort(-log_proba)[:2]].tolist()
+        self.assertEqual(self.pipe.most_probable_classes(rows[:1], k=2)[0],
+                         expected + [self.pipe.classes[-1]])
+        instance = self.pipe.unlabeled_corpus.get_instance(rows[0])[0]
+        self.pipe.number_of_classes = 2
+        self.assertEqual(self.pipe._most_probable_classes(instance),
+                         expected + [self.pipe.classes[-1]])
+
     def test_label_feature_corpus(self):
         """The new feature information must be saved into feature_corpus_f.
         """
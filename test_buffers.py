@@ -0,0 +1,132 @@
+import unittest
+import numpy as np
+
+from buffers import (GrowableArray, CSRBuffer, LazyHeap, LazyStringList,
+                     RaggedArray)
+from scipy.sparse import csr_matrix
+
+
+class TestGrowableArray(unittest.TestCase):
+
+    def test_append(self):
+        """The view must contain the appended values in order."""
+        array = GrowableArray(dtype=np.int32, capacity=1)
+        for value in range(100):
+            array.append(value)
+        self.assertEqual(len(array), 100)
+        np.testing.assert_array_equal(array.view(), np.arange(100))
+        self.assertEqual(array.dtype, np.int32)
+
+    def test_extend_promotes_type(self):
+        """Adding wider values must not truncate them."""
+        array = GrowableArray(np.array([1, 2]))
+        array.extend(np.array([0.5]))
+        np.testing.assert_array_equal(array.view(), [1, 2, 0.5])
+
+
+class TestRaggedArray(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = [[1, 2], [], [3], [4, 5, 6]]
+        self.array = RaggedArray.from_lists(self.rows)
+
+    def test_append(self):
+        self.array.append([7, 8])
+        self.assertEqual(self.array.tolists(), self.rows + [[7, 8]])
+        self.assertEqual(self.array.row(4).tolist(), [7, 8])
+
+    def test_take(self):
+        """The rows must be selected in the given order."""
+        result = self.array.take([3, 0, 1])
+        self.assertEqual(result.tolists(), [[4, 5, 6], [1, 2], []])
+
+    def test_compress(self):
+        self.array.compress([False, True, True, True])
+        self.assertEqual(self.array.tolists(), self.rows[1:])
+
+
+class TestCSRBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = np.array([[0, 1, 0], [2, 0, 3], [0, 0, 0], [4, 5, 6]])
+
+    def test_append(self):
+        """The materialized matrix must be equal to the appended rows."""
+        buffer = CSRBuffer()
+        for row in self.rows:
+            buffer.append(row)
+        self.assertEqual(buffer.shape, self.rows.shape)
+        np.testing.assert_array_equal(buffer.tocsr().toarray(), self.rows)
+
+    def test_extend_existing_matrix(self):
+        """Extending a buffer must not modify the original matrix."""
+        matrix = csr_matrix(self.rows[:2])
+        buffer = CSRBuffer(matrix)
+        buffer.extend(csr_matrix(self.rows[2:]))
+        np.testing.assert_array_equal(buffer.tocsr().toarray(), self.rows)
+        np.testing.assert_array_equal(matrix.toarray(), self.rows[:2])
+
+    def test_materialized_matrix_is_not_modified(self):
+        """A matrix returned by tocsr must not see rows added later."""
+        buffer = CSRBuffer(self.rows[:1])
+        matrix = buffer.tocsr()
+        buffer.extend(self.rows[1:])
+        self.assertEqual(matrix.shape, (1, 3))
+        np.testing.assert_array_equal(matrix.toarray(), self.rows[:1])
+
+    def test_compress(self):
+        """Only the selected rows must be kept."""
+        buffer = CSRBuffer(self.rows)
+        mask = [True, False, True, False]
+        buffer.compress(mask)
+        np.testing.assert_array_equal(buffer.tocsr().toarray(),
+                                      self.rows[[0, 2]])
+        np.testing.assert_array_equal(buffer.getrow(0).toarray(),
+                                      self.rows[:1])
+
+    def test_wrong_number_of_features(self):
+        buffer = CSRBuffer(self.rows)
+        self.assertRaises(ValueError, buffer.append, [1, 2])
+
+
+class TestLazyStringList(unittest.TestCase):
+
+    def test_compress_keeps_types(self):
+        """The unicode strings must be read as unicode after compressing."""
+        strings = LazyStringList.from_strings([u'caf\xe9', None, 'cafe'])
+        self.assertEqual(list(strings), [u'caf\xe9', None, 'cafe'])
+        compressed = strings.compress([True, False, True])
+        self.assertEqual([type(value) for value in compressed],
+                         [unicode, str])
+
+
+class TestLazyHeap(unittest.TestCase):
+
+    def test_pop(self):
+        """The rows must be popped by score, skipping the removed ones."""
+        scores = np.array([0.5, 0.1, 0.9, 0.1, 0.3])
+        row_ids = np.array([10, 11, 12, 13, 14])
+        removed = set([11])
+        heap = LazyHeap(scores, row_ids, capacity=3)
+        self.assertEqual(len(heap), 3)
+        is_valid = lambda row_id: row_id not in removed
+        self.assertEqual(heap.peek(is_valid), 13)
+        self.assertEqual([heap.pop(is_valid) for _ in range(3)],
+                         [13, 14, None])
+        heap = LazyHeap(scores, row_ids)
+        self.assertEqual([heap.pop(is_valid) for _ in range(4)],
+                         [13, 14, 10, 12])
+
+    def test_ties(self):
+        """The rows tied with the last selected one must be selected by
+        row id."""
+        scores = np.array([0.5, 0.1, 0.5, 0.5, 0.5, 0.5])
+        row_ids = np.array([15, 20, 14, 11, 13, 12])
+        heap = LazyHeap(scores, row_ids, capacity=3)
+        is_valid = lambda row_id: True
+        self.assertEqual([heap.pop(is_valid) for _ in range(4)],
+                         [20, 11, 12, None])
+
+
+if __name__ == '__main__':
+    unittest.main()
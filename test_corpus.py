@@ -1,5 +1,16 @@
 import unittest
 import corpus
+import numpy as np
+import shutil
+import tempfile
+
+from buffers import LazyStringList
+
+
+class FakeVectorizer(object):
+    """Names the column i of the matrix as feature_i."""
+    def column_to_feature(self, i):
+        return (None, 'feature_{}'.format(i))
 
 
 class TestCorpus(unittest.TestCase):
@@ -23,12 +34,248 @@ class TestCorpus(unittest.TestCase):
                 # Check the targets still corresponds to the instances
                 self.assertEqual(str(instance.toarray()[0][0]), target)
 
+    def test_add_instance(self):
+        """The instances matrix must have one row for each added instance."""
+        self.assertEqual(self.corpus.instances.shape, (self.size, 1))
+        self.assertEqual(self.corpus.instances[42].toarray()[0][0], 42)
+        self.assertEqual(self.corpus.primary_targets[42], '42')
+
+    def test_iter_chunks(self):
+        """The chunks must cover all the live instances in order."""
+        self.corpus.pop_instance(0)
+        chunks = list(self.corpus.iter_chunks(rows=30))
+        self.assertEqual([start for start, _ in chunks], [0, 30, 60, 90])
+        self.assertEqual(chunks[-1][1].shape, (9, 1))
+        values = [chunk.toarray()[:, 0] for _, chunk in chunks]
+        np.testing.assert_array_equal(np.concatenate(values),
+                                      np.arange(1, self.size))
+
+    def test_concatenate_corpus(self):
+        """All the instances of the new corpus must be added at the end."""
+        new_corpus = corpus.Corpus()
+        new_corpus.add_instance([self.size], ['a', 'b', 'b'])
+        self.corpus.concetenate_corpus(new_corpus)
+        self.assertEqual(len(self.corpus), self.size + 1)
+        self.assertEqual(self.corpus.instances[-1].toarray()[0][0], self.size)
+        self.assertEqual(self.corpus.primary_targets[-1], 'b')
+        self.assertTrue(self.corpus.check_consistency())
+
+    def test_calculate_primary_targets(self):
+        """The most frequent target must be selected, or the first one."""
+        new_corpus = corpus.Corpus()
+        targets = [['a', 'b', 'b'], ['c', 'a'], [], ['b', 'a', 'a', 'b'],
+                   ['d']]
+        for index, target in enumerate(targets):
+            new_corpus.add_instance([index], target)
+        expected = ['b', 'c', None, 'b', 'd']
+        self.assertEqual(new_corpus.primary_targets, expected)
+        new_corpus.calculate_primary_targets()
+        self.assertEqual(new_corpus.primary_targets, expected)
+        self.assertEqual(new_corpus.classes, ['a', 'b', 'c', 'd'])
+        self.assertEqual(new_corpus.primary_target_codes.tolist(),
+                         [1, 2, -1, 1, 3])
+        self.assertEqual(new_corpus.full_targets, targets)
+
+    def test_pop_instance(self):
+        """The popped instances must not be seen in the corpus."""
+        self.corpus.add_extra_info('score', range(self.size))
+        instance, targets, _ = self.corpus.pop_instance(10)
+        self.assertEqual(instance.toarray()[0][0], 10)
+        self.assertEqual(targets, ['10'])
+        self.assertEqual(len(self.corpus), self.size - 1)
+        self.assertNotIn('10', self.corpus.primary_targets)
+        self.assertEqual(self.corpus.instances.shape, (self.size - 1, 1))
+        self.assertNotIn(10, self.corpus.extra_info['score'])
+        self.assertTrue(self.corpus.check_consistency())
+        self.assertRaises(IndexError, self.corpus.pop_instance, 10)
+
+    def test_pop_instance_row_ids(self):
+        """The row ids must not change after popping other instances."""
+        for row_id in range(0, self.size, 2):
+            self.corpus.pop_instance(row_id)
+        self.assertEqual(self.corpus.row_ids.tolist(),
+                         range(1, self.size, 2))
+        instance, targets, _ = self.corpus.get_instance(51)
+        self.assertEqual(instance.toarray()[0][0], 51)
+        self.assertEqual(self.corpus.get_primary_target(51), '51')
+
+    def test_get_instances(self):
+        """The instances must be returned in the order of the row ids."""
+        self.corpus.pop_instance(3)
+        instances = self.corpus.get_instances([7, 2, 50])
+        self.assertEqual(instances.toarray()[:, 0].tolist(), [7, 2, 50])
+        self.assertRaises(IndexError, self.corpus.get_instances, [2, 3])
+        self.assertRaises(IndexError, self.corpus.get_instances, [self.size])
+        self.assertIn(2, self.corpus)
+        self.assertNotIn(3, self.corpus)
+
+    def test_add_extra_info(self):
+        """The extra info must be kept aligned with the instances."""
+        scores = np.arange(self.size, dtype=np.float32)
+        self.assertTrue(self.corpus.add_extra_info('score', scores))
+        self.assertFalse(self.corpus.add_extra_info('bad', scores[1:]))
+        self.corpus.add_instance([self.size], ['a'])
+        new_corpus = corpus.Corpus()
+        new_corpus.add_instance([self.size + 1], ['b'])
+        self.corpus.concetenate_corpus(new_corpus)
+        score = self.corpus.extra_info['score']
+        self.assertEqual(score.dtype, np.float32)
+        np.testing.assert_array_equal(score[-3:], [self.size - 1, 0, 0])
+        self.assertTrue(self.corpus.check_consistency())
+
+    def test_argmin_extra_info(self):
+        """The deleted instances must not be selected."""
+        self.corpus.add_extra_info('score', range(self.size))
+        self.corpus.pop_instance(0)
+        self.assertEqual(self.corpus.argmin_extra_info('score'), 1)
+
+    def test_deduplicate(self):
+        """The identical instances must be collapsed into weighted rows."""
+        new_corpus = corpus.Corpus()
+        rows = [[1, 0, 2], [0, 1, 0], [1, 0, 2], [0, 0, 0], [1, 0, 2]]
+        targets = [['a'], ['b'], ['b'], [], ['a']]
+        for row, target in zip(rows, targets):
+            new_corpus.add_instance(np.array(row), target)
+        new_corpus.pop_instance(3)
+        result, inverse = new_corpus.deduplicate()
+        np.testing.assert_array_equal(result.instances.toarray(),
+                                      [[1, 0, 2], [0, 1, 0]])
+        self.assertEqual(inverse.tolist(), [0, 1, 0, 0])
+        self.assertEqual(result.extra_info['weight'].tolist(), [3, 1])
+        self.assertEqual(result.members.tolists(), [[0, 2, 4], [1]])
+        self.assertIs(new_corpus.deduplicate()[0], result)
+
+        result, inverse = new_corpus.deduplicate(by_target=True)
+        self.assertEqual(result.primary_targets, ['a', 'b', 'b'])
+        self.assertEqual(result.members.tolists(), [[0, 4], [1], [2]])
+
+    def test_version(self):
+        """The version must change with the rows but not when they are read.
+        """
+        version = self.corpus.version
+        self.corpus.instances
+        self.corpus.add_extra_info('score')
+        self.assertEqual(self.corpus.version, version)
+        self.corpus.pop_instance(0)
+        self.assertGreater(self.corpus.version, version)
+        version = self.corpus.version
+        self.corpus.add_instance([1], ['a'])
+        self.assertGreater(self.corpus.version, version)
+
+    def test_split_corpus_seed(self):
+        """The same seed must give the same partitions."""
+        first = self.corpus.split([10, 20], seed=7)
+        second = self.corpus.split([10, 20], seed=7)
+        for corpus1, corpus2 in zip(first, second):
+            self.assertEqual(corpus1.primary_targets, corpus2.primary_targets)
+            self.assertEqual(corpus1.representations,
+                             corpus2.representations)
+
+    def test_split_corpus_stratified(self):
+        """Each partition must keep the class distribution of the corpus."""
+        stratified = corpus.Corpus()
+        for index in range(self.size):
+            stratified.add_instance([index], ['a' if index % 4 else 'b'])
+        splited_corpus = stratified.split([40, 20], seed=3, stratified=True)
+        self.assertEqual(splited_corpus[0].class_info(), {'a': 30, 'b': 10})
+        self.assertEqual(splited_corpus[1].class_info(), {'a': 15, 'b': 5})
+        for instance, target in zip(splited_corpus[1].instances,
+                                    splited_corpus[1].primary_targets):
+            self.assertEqual(instance.toarray()[0][0] % 4 == 0, target == 'b')
+
+    def test_save_to_directory(self):
+        """A saved corpus must be loaded with the same content."""
+        dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname)
+        self.corpus.add_instance([self.size], ['a', 'b', 'b'], u'\xe1rbol')
+        self.corpus.pop_instance(0)
+        self.corpus.save_to_file(dirname)
+        new_corpus = corpus.Corpus()
+        new_corpus.load_from_file(dirname)
+        # The arrays are memory mapped in read only mode
+        self.assertFalse(new_corpus.instances.data.flags.writeable)
+        np.testing.assert_array_equal(new_corpus.instances.toarray(),
+                                      self.corpus.instances.toarray())
+        self.assertEqual(new_corpus.full_targets, self.corpus.full_targets)
+        self.assertEqual(new_corpus.primary_targets,
+                         self.corpus.primary_targets)
+        self.assertEqual(new_corpus.representations[:-1], [None] * 99)
+        self.assertEqual(new_corpus.representations[-1], u'\xe1rbol')
+        # The memory mapped corpus can still be modified
+        new_corpus.pop_instance(1)
+        new_corpus.add_instance([1], ['1'])
+        self.assertEqual(len(new_corpus), self.size)
+        self.assertTrue(new_corpus.check_consistency())
+
+    def test_save_keeps_string_types(self):
+        """The unicode and byte strings must be loaded with the same type.
+        """
+        dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname)
+        typed_corpus = corpus.Corpus()
+        typed_corpus.add_instance([1, 0], ['a'], u'caf\xe9')
+        typed_corpus.add_instance([0, 1], [u'\xe1'], 'cafe')
+        feature_names = [u'caf\xe9', 'cafe']
+        typed_corpus._feature_names = LazyStringList.from_strings(
+            feature_names)
+        typed_corpus.save_to_file(dirname)
+        new_corpus = corpus.Corpus()
+        new_corpus.load_from_file(dirname)
+        for original, loaded in [
+                (typed_corpus.representations, new_corpus.representations),
+                (typed_corpus.classes, new_corpus.classes),
+                (feature_names, new_corpus.get_feature_names([0, 1]))]:
+            self.assertEqual(list(loaded), list(original))
+            self.assertEqual([type(value) for value in loaded],
+                             [type(value) for value in original])
+        self.assertEqual(new_corpus.get_feature_index(u'caf\xe9'), 0)
+
+    def test_feature_names(self):
+        """The feature names must be saved and used without the vectorizer.
+        """
+        dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname)
+        feature_corpus = corpus.Corpus()
+        for row in np.eye(3):
+            feature_corpus.add_instance(row, ['a'])
+        feature_corpus._features_vectorizer = FakeVectorizer()
+        self.assertEqual(feature_corpus.get_feature_name(1), 'feature_1')
+        feature_corpus.save_to_file(dirname)
+        new_corpus = corpus.Corpus()
+        new_corpus.load_from_file(dirname)
+        self.assertEqual(new_corpus.get_feature_names([2, 0]),
+                         ['feature_2', 'feature_0'])
+        self.assertEqual(new_corpus.get_feature_index('feature_1'), 1)
+        self.assertIsNone(new_corpus.get_feature_index('feature_3'))
+        self.assertIsNone(new_corpus._features_vectorizer)
+
+    def test_convert_pickle_corpus(self):
+        """The converted corpus must be equal to the pickled one."""
+        dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname)
+        pickle_filename = 'test_files/training_corpus.pickle'
+        converted = corpus.convert_pickle_corpus(pickle_filename, dirname)
+        new_corpus = corpus.Corpus()
+        new_corpus.load_from_file(dirname)
+        np.testing.assert_array_equal(new_corpus.instances.toarray(),
+                                      converted.instances.toarray())
+        self.assertEqual(new_corpus.full_targets, converted.full_targets)
+        self.assertEqual(list(new_corpus.representations),
+                         converted.representations)
+
     def test_split_corpus_bigger(self):
         """The sums of the parts is bigger than the corpus."""
         partitions = [10, 90, 10]
         splited_corpus = self.corpus.split(partitions)
         self.assertIsNone(splited_corpus)
 
+    def test_split_empty_corpus(self):
+        """A corpus without rows must give empty partitions."""
+        partitions = corpus.Corpus().split([0])
+        self.assertEqual(len(partitions), 1)
+        self.assertEqual(len(partitions[0]), 0)
+        self.assertEqual(partitions[0].primary_targets, [])
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
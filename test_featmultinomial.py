@@ -6,7 +6,7 @@ using labeled features.
 import unittest
 import numpy as np
 
-from featmultinomial import FeatMultinomalNB
+from featmultinomial import FeatMultinomialNB
 from copy import deepcopy
 from math import log
 from sklearn import tree
@@ -94,7 +94,7 @@ ig_correct_anwers = [0.636514, 0.636514, 0.0, 0.17441]
 class TestFeatMultinomialNB(unittest.TestCase):
 
     def setUp(self):
-        self.fmnb = FeatMultinomalNB()
+        self.fmnb = FeatMultinomialNB()
         self.fmnb.fit(X, Y)
 
     def test_fit(self):
@@ -104,6 +104,47 @@ class TestFeatMultinomialNB(unittest.TestCase):
         self.assertNotEqual(no_feat_prior[0][2], feat_prior[0][2])
         self.assertTrue(np.all(self.fmnb.alpha == features))
 
+    def test_partial_fit(self):
+        """Adding the instances one by one must give the same counts."""
+        fmnb = FeatMultinomialNB()
+        fmnb.partial_fit(X[:1], Y[:1], classes=[0, 1])
+        fmnb.partial_fit(X[1:], Y[1:], features=features)
+        self.fmnb.fit(X, Y, features=features)
+        for attribute in ['feature_count_', 'class_count_',
+                          'count_feat_and_class', 'feature_log_prob_',
+                          'class_log_prior_', 'feat_information_gain']:
+            np.testing.assert_array_almost_equal(
+                getattr(fmnb, attribute), getattr(self.fmnb, attribute)
+            )
+        self.assertEqual(fmnb.instance_num, X.shape[0])
+
+    def test_update_class_features(self):
+        """Changing the boost of a class must be equal to fitting again."""
+        information_gain = self.fmnb.feat_information_gain.copy()
+        self.fmnb.update_class_features(1, features[1])
+        expected = FeatMultinomialNB().fit(X, Y, features=np.array(
+            [[1.0] * 4, features[1]]
+        ))
+        np.testing.assert_array_almost_equal(self.fmnb.feature_log_prob_,
+                                             expected.feature_log_prob_)
+        np.testing.assert_array_equal(self.fmnb.feat_information_gain,
+                                      information_gain)
+
+    def test_feature_updates(self):
+        """The stored update must give the new row from the old one."""
+        version = self.fmnb.model_version
+        old_row = self.fmnb.feature_log_prob_[1].copy()
+        self.fmnb.update_class_features(1, features[1])
+        class_number, columns, column_change, shift = \
+            self.fmnb.feature_updates[version]
+        self.assertEqual(class_number, 1)
+        new_row = old_row + shift
+        new_row[columns] = old_row[columns] + column_change
+        np.testing.assert_array_almost_equal(self.fmnb.feature_log_prob_[1],
+                                             new_row)
+        self.fmnb.class_log_prior_ = self.fmnb.class_log_prior_
+        self.assertEqual(self.fmnb.feature_updates, {})
+
     def test_information_gain(self):
         ig = self.fmnb.feat_information_gain
         self.assertEqual(ig.shape[0], X.shape[1])
@@ -133,10 +174,49 @@ class TestFeatMultinomialNB(unittest.TestCase):
         self.assertEqual(result.shape, (4,))
         np.testing.assert_array_almost_equal(result, expected, decimal=3)
 
+    def test_dtype(self):
+        """A float32 classifier must give the same predictions."""
+        fmnb = FeatMultinomialNB(dtype=np.float32).fit(X, Y,
+                                                       features=features)
+        self.fmnb.fit(X, Y, features=features)
+        self.assertEqual(fmnb.feature_log_prob_.dtype, np.float32)
+        self.assertEqual(fmnb.class_log_prior_.dtype, np.float32)
+        np.testing.assert_array_almost_equal(fmnb.predict_proba(X),
+                                             self.fmnb.predict_proba(X))
+
+    def test_instance_log_proba(self):
+        """The log probability must not underflow for long instances."""
+        instances = np.array([[0, 1, 3, 1], [2000, 1000, 5000, 400]])
+        result = self.fmnb.instance_log_proba(instances)
+        self.assertTrue(np.all(np.isfinite(result)))
+        self.assertAlmostEqual(np.exp(result[0]),
+                               self.fmnb.instance_proba(instances)[0])
+
+    def test_joint_and_instance_log_proba(self):
+        jll, log_proba = self.fmnb.joint_and_instance_log_proba(X)
+        np.testing.assert_array_almost_equal(
+            jll, self.fmnb._joint_log_likelihood(X)
+        )
+        np.testing.assert_array_almost_equal(
+            log_proba, self.fmnb.instance_log_proba(X)
+        )
+
+    def test_instance_log_proba_cache(self):
+        """The cached probabilities must change with the model."""
+        instances = np.array([[0, 1, 3, 1]])
+        before = self.fmnb.instance_log_proba(instances)
+        self.fmnb.class_log_prior_ = np.log(np.array([0.1, 0.9]))
+        after = self.fmnb.instance_log_proba(instances)
+        self.assertNotAlmostEqual(before[0], after[0])
+        self.fmnb.update_class_features(0, features[0] * 10)
+        self.assertNotAlmostEqual(
+            after[0], self.fmnb.instance_log_proba(instances)[0]
+        )
+
 
 class TestIGwithDecisionTree(unittest.TestCase):
     def setUp(self):
-      self.fmnb = FeatMultinomalNB()
+      self.fmnb = FeatMultinomialNB()
       self.dtree = tree.DecisionTreeClassifier(criterion='entropy',
                                                min_samples_split=1,
                                                min_samples_leaf=1)
@@ -0,0 +1,92 @@
+import unittest
+import numpy as np
+
+import query_strategies
+from activepipe import ActivePipeline
+from scipy.sparse import vstack
+from sklearn.base import clone
+from test_activepipe import testing_config
+
+
+class TestQueryStrategies(unittest.TestCase):
+
+    def setUp(self):
+        self.pipe = ActivePipeline(**testing_config)
+        self.posterior = np.array([[0.5, 0.3, 0.2],
+                                   [1.0, 0.0, 0.0],
+                                   [0.1, 0.1, 0.8]])
+
+    def test_entropy(self):
+        """The zero probabilities must not give nan."""
+        result = query_strategies.entropy(self.pipe, None, self.posterior)
+        expected = (np.log(self.posterior[[0, 2]]) *
+                    self.posterior[[0, 2]]).sum(axis=1)
+        np.testing.assert_array_almost_equal(result, [expected[0], 0,
+                                                      expected[1]])
+
+    def test_least_confidence(self):
+        result = query_strategies.least_confidence(self.pipe, None,
+                                                   self.posterior)
+        np.testing.assert_array_almost_equal(result, [0.5, 1.0, 0.8])
+
+    def test_margin(self):
+        result = query_strategies.margin(self.pipe, None, self.posterior)
+        np.testing.assert_array_almost_equal(result, [0.2, 1.0, 0.7])
+
+    def test_vote_entropy(self):
+        """The votes of a committee of one classifier never disagree."""
+        corpus, posterior, _ = self.pipe._unlabeled_posterior()
+        self.pipe.committee_size = 1
+        result = query_strategies.vote_entropy(self.pipe, corpus, posterior)
+        np.testing.assert_array_equal(result, np.zeros(len(corpus)))
+        self.pipe.committee_size = 4
+        result = query_strategies.vote_entropy(self.pipe, corpus, posterior)
+        self.assertEqual(result.shape, (len(corpus),))
+        self.assertTrue(np.all(result <= 0))
+
+    def test_expected_error_reduction(self):
+        """The error must be the one of the classifier fitted again with
+        each candidate."""
+        corpus, posterior, _ = self.pipe._unlabeled_posterior()
+        result = query_strategies.expected_error_reduction(self.pipe, corpus,
+                                                           posterior)
+        training = self.pipe.training_corpus
+        classes = self.pipe.classifier.classes_
+        expected = []
+        for row in range(len(corpus)):
+            score = 0
+            for class_number, target in enumerate(classes):
+                classifier = clone(self.pipe.classifier).fit(
+                    vstack((training.instances, corpus.instances[row])),
+                    training.primary_targets + [target]
+                )
+                error = (1 - classifier.predict_proba(
+                    corpus.instances).max(axis=1)).sum()
+                score += posterior[row, class_number] * error
+            expected.append(score)
+        np.testing.assert_array_almost_equal(result, expected)
+
+    def test_subsample(self):
+        """Only eer_subsample instances must be candidates."""
+        corpus, posterior, _ = self.pipe._unlabeled_posterior()
+        self.pipe.eer_subsample = 2
+        result = query_strategies.expected_error_reduction(self.pipe, corpus,
+                                                           posterior)
+        self.assertEqual(np.isfinite(result).sum(), 2)
+
+    def test_select_by_name(self):
+        """The pipe must select the instances with its query_strategy."""
+        for name in query_strategies.STRATEGIES:
+            self.pipe.query_strategy = name
+            row_id = self.pipe.get_next_instance()
+            scores = self.pipe.unlabeled_corpus.extra_info[name]
+            self.assertEqual(scores[row_id], scores.min())
+
+    def test_get_next_instance_function(self):
+        """The result of the selection function must be returned."""
+        self.pipe.get_next_instance_function = lambda pipe: 3
+        self.assertEqual(self.pipe.get_next_instance(), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
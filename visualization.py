@@ -68,8 +68,9 @@ def feature_bootstrap(activepipe, get_class, get_labeled_features,
                 len(e_prediction), class_name
             ))
         if feature_numbers:
-            feature_names = [activepipe.training_corpus.get_feature_name(pos)
-                             for pos in feature_numbers]
+            feature_names = activepipe.training_corpus.get_feature_names(
+                feature_numbers
+            )
             prediction = get_labeled_features(class_name, feature_names)
             if not prediction and not e_prediction:
                 continue
@@ -88,7 +89,8 @@ def feature_bootstrap(activepipe, get_class, get_labeled_features,
     return result
 
 
-def instance_bootstrap(activepipe, get_labeled_instance, max_iterations=None):
+def instance_bootstrap(activepipe, get_labeled_instance, max_iterations=None,
+                       batch_size=None):
     """Presents a new question to the user until the answer is 'stop'.
 
     Args:
@@ -97,47 +99,74 @@ def instance_bootstrap(activepipe, get_labeled_instance, max_iterations=None):
         class for the instance.
         max_iterations: Optional. An integer. The cycle will execute at
         most max_iterations times if the user does not enter stop before.
+        batch_size: Optional. An integer, by default the instance_batch_size
+        of the pipe. If it is more than 1, the questions are selected in
+        batches of diverse instances with get_next_instances, and the
+        classifier is trained after each batch is labeled.
 
     Returns:
         The number of instances the user has labeled.
     """
     printer = Printer()
+    if batch_size is None:
+        batch_size = activepipe.instance_batch_size
 
     it = 0
     result = 0
+    stop = False
     while ((not max_iterations or it < max_iterations) and
-          len(activepipe.unlabeled_corpus)):
-        it += 1
-        new_index = activepipe.get_next_instance()
-        try:
-            new_instance = activepipe.unlabeled_corpus.instances[new_index]
-        except IndexError:
-            import ipdb; ipdb.set_trace()
-        representation = activepipe.unlabeled_corpus.representations[new_index]
-        if (activepipe.emulate and
-            activepipe.unlabeled_corpus.primary_targets[new_index]):
-            prediction = activepipe.unlabeled_corpus.primary_targets[new_index]
-            message = "Emulation: Adding instance {}, {}".format(
-                representation, prediction
-            )
-            printer.info(message)
-        if (not activepipe.emulate or
-            not activepipe.unlabeled_corpus.primary_targets[new_index]):
-            classes = activepipe._most_probable_classes(new_instance)
-            prediction = get_labeled_instance(representation, classes)
-        if prediction == 'stop':
+          len(activepipe.unlabeled_corpus) and not stop):
+        if batch_size > 1:
+            batch = activepipe.get_next_instances(batch_size)
+            if not activepipe.emulate:
+                # The suggestions of the whole batch are calculated at once
+                activepipe.most_probable_classes(batch)
+        else:
+            batch = [activepipe.get_next_instance()]
+        if not batch or batch[0] is None:
             break
-        if prediction == 'train':
+        labeled = 0
+        for new_index in batch:
+            if max_iterations and it >= max_iterations:
+                break
+            it += 1
+            new_instance, _, representation = \
+                activepipe.unlabeled_corpus.get_instance(new_index)
+            primary_target = activepipe.unlabeled_corpus.get_primary_target(
+                new_index
+            )
+            if activepipe.emulate and primary_target:
+                prediction = primary_target
+                message = "Emulation: Adding instance {}, {}".format(
+                    representation, prediction
+                )
+                printer.info(message)
+            if not activepipe.emulate or not primary_target:
+                classes = activepipe.most_probable_classes([new_index])[0]
+                prediction = get_labeled_instance(representation, classes)
+            if prediction == 'stop':
+                stop = True
+                break
+            if prediction == 'train':
+                # The rest of the batch is selected again
+                labeled = 0
+                activepipe._train()
+                if activepipe.can_run_em:
+                    activepipe._expectation_maximization()
+                break
+
+            activepipe.new_instances += 1
+            result += 1
+            labeled += 1
+            instance, targets, r = activepipe.unlabeled_corpus.pop_instance(
+                new_index
+            )
+            activepipe.user_corpus.add_instance(
+                instance, [prediction] + targets, r
+            )
+        if batch_size > 1 and labeled and not stop:
             activepipe._train()
             if activepipe.can_run_em:
                 activepipe._expectation_maximization()
-            continue
-
-        activepipe.new_instances += 1
-        result += 1
-        instance, targets, r = activepipe.unlabeled_corpus.pop_instance(new_index)
-        activepipe.user_corpus.add_instance(
-            instance, [prediction] + targets, r
-        )
 
     return result